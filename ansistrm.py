@@ -52,7 +52,9 @@ class ColorizingStreamHandler(logging.StreamHandler):
             else:
                 self.output_colorized(message)
             stream.write(getattr(self, 'terminator', '\n'))
-            self.flush()
+            # a terminal has to see every record as it happens, anything else can be buffered
+            if self.is_tty:
+                self.flush()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+# vim: ts=3:sw=3:et
+
+# Times the exports end to end against a synthetic indicator corpus served by
+# in-memory stand-ins for the CRITS mongo database and the SIP API, so changes
+# to the exporters can be measured without either of them.
+#
+# Each case runs in its own process so the peak RSS is that of the case alone
+# (which includes the corpus).  The time of the run is split into the stages
+# in STAGES, which add up to the seconds of the run.  The sip-yara-delta case is the run after a full
+# sync into the SIP indicator store (sip_export_yara.py), once a share of the indicators
+# changed, and sip-splunk-tenants exports the lookup tables of several tenants at once
+# (sip_export_splunk.py).  The results can be saved as a baseline and later runs are
+# compared against it.
+#
+#   ./benchmark.py --size 100000 --mix paths --save-baseline
+#   ./benchmark.py --size 100000 --mix paths --set global.render_workers=8
+
+import argparse
+import json
+import logging
+import os
+import os.path
+import random
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import defaultdict
+from configparser import ConfigParser
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import parse_qs, urlencode
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# case name -> (source, sinks, options)
+# delta: the indicator store is filled by a full sync first, the case is the delta sync after DELTA_SHARE of the indicators changed
+# tenants: the number of tenants the splunk lookup tables are exported for
+CASES = {
+   'crits-yara': ('crits', ['yara'], {}),
+   'crits-splunk': ('crits', ['splunk'], {}),
+   'crits-ssdeep': ('crits', ['ssdeep'], {}),
+   'crits-all': ('crits', ['yara', 'splunk', 'ssdeep'], {}),
+   'sip-yara': ('sip', ['yara'], {}),
+   'sip-yara-delta': ('sip', ['yara'], { 'delta': True }),
+   'sip-splunk': ('sip', ['splunk'], {}),
+   'sip-splunk-tenants': ('sip', ['splunk'], { 'tenants': 3 }),
+}
+
+# the share of the indicators that change between the two runs of a delta case
+DELTA_SHARE = 0.01
+
+# the share of each indicator type in the corpus
+MIXES = {
+   'default': { 'Windows - FilePath': 2, 'Windows - Registry': 2, 'URI - URL': 2, 'URI - Domain Name': 2, 'Address - ipv4-addr': 2,
+                'Hash - MD5': 2, 'Hash - SHA256': 2, 'String - PE': 2, 'Email - Address': 1, 'Hash - SSDEEP': 1 },
+   'paths': { 'Windows - FilePath': 14, 'Windows - Registry': 2, 'URI - URL': 2, 'String - PE': 1, 'Hash - SSDEEP': 1 },
+   'registry': { 'Windows - Registry': 14, 'Windows - FilePath': 2, 'URI - URL': 2, 'String - PE': 1, 'Hash - SSDEEP': 1 },
+   'urls': { 'URI - URL': 14, 'URI - Domain Name': 2, 'Windows - FilePath': 2, 'String - PE': 1, 'Hash - SSDEEP': 1 },
+}
+
+# sources of the corpus, excluded is filtered out by the exporters
+SOURCES = ['osint', 'internal', 'vendor', 'excluded']
+
+DEFAULT_BASELINE = 'var/benchmark_baseline.json'
+
+#
+# synthetic corpus
+#
+
+def random_word(rnd, size=8):
+   return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(3, size)))
+
+def random_path(rnd):
+   prefix = rnd.choice(['%TEMP%', '%APPDATA%', '%ProgramData%', '%ProgramFiles%', '%SystemDrive%', '%System%', 'C:', 'C:\\Users\\' + random_word(rnd)])
+   return '\\'.join([prefix] + [random_word(rnd) for _ in range(rnd.randint(0, 4))] + [random_word(rnd) + '.exe'])
+
+def random_registry(rnd):
+   hive = rnd.choice(['HKCU\\', 'HKLM\\', 'HKCR\\', 'HKU\\', ''])
+   return hive + '\\'.join(['Software'] + [random_word(rnd).capitalize() for _ in range(rnd.randint(1, 5))])
+
+def random_domain(rnd):
+   return '{0}.{1}'.format(random_word(rnd, 12), rnd.choice(['com', 'net', 'org', 'ru', 'info']))
+
+def random_url(rnd):
+   return '{0}://{1}/{2}?{3}={4}'.format(rnd.choice(['http', 'https', 'HTTP']), random_domain(rnd),
+      '/'.join(random_word(rnd) for _ in range(rnd.randint(1, 4))), random_word(rnd), random_word(rnd))
+
+def random_string(rnd):
+   # some strings need escaping in the yara rules
+   return rnd.choice(['', '"', '\\']).join(random_word(rnd, 16) for _ in range(rnd.randint(1, 4)))
+
+def random_hex(rnd, size):
+   return '{0:0{1}x}'.format(rnd.getrandbits(size * 4), size)
+
+VALUE_GENERATORS = {
+   'Windows - FilePath': random_path,
+   'Windows - Registry': random_registry,
+   'URI - URL': random_url,
+   'URI - Domain Name': random_domain,
+   'Address - ipv4-addr': lambda rnd: '.'.join(str(rnd.randint(1, 254)) for _ in range(4)),
+   'Hash - MD5': lambda rnd: random_hex(rnd, 32),
+   'Hash - SHA256': lambda rnd: random_hex(rnd, 64),
+   'String - PE': random_string,
+   'Email - Address': lambda rnd: '{0}@{1}'.format(random_word(rnd), random_domain(rnd)),
+   'Hash - SSDEEP': lambda rnd: '{0}:{1}:{2}'.format(rnd.choice([3, 6, 12, 24]), random_word(rnd, 32), random_word(rnd, 16)),
+}
+
+# returns (indicators, samples) as stored in CRITS
+# about 5% of the values repeat an earlier value of the same type to exercise the deduplication
+def generate_corpus(size, mix, seed=0):
+   rnd = random.Random(seed)
+   types = sorted(MIXES[mix])
+   weights = [MIXES[mix][indicator_type] for indicator_type in types]
+
+   samples = []
+   for index in range(max(size // 100, 1)):
+      samples.append({ '_id': '{0:024x}'.format(index + 1), 'mimetype': rnd.choice(['application/x-dosexec', 'application/msword', 'text/plain']) })
+
+   indicators = []
+   # indicator type -> the values generated so far
+   values = defaultdict(list)
+   for index in range(size):
+      indicator_type = rnd.choices(types, weights)[0]
+      if values[indicator_type] and rnd.random() < 0.05:
+         value = rnd.choice(values[indicator_type])
+      else:
+         value = VALUE_GENERATORS[indicator_type](rnd)
+         values[indicator_type].append(value)
+
+      indicators.append({
+         '_id': '{0:024x}'.format(0x100000000 + index),
+         'type': indicator_type,
+         'value': value,
+         'status': 'Analyzed' if rnd.random() < 0.9 else 'New',
+         'source': [ { 'name': name } for name in rnd.sample(SOURCES, rnd.randint(1, 2)) ],
+         'relationships': [ { 'value': rnd.choice(samples)['_id'] } for _ in range(rnd.randint(0, 2)) ],
+         'bucket_list': [ random_word(rnd) ],
+         'campaign': [],
+      })
+
+   return indicators, samples
+
+#
+# in-memory stand-in for the CRITS mongo database
+# supports only the queries the exporters make
+#
+
+def match_value(value, condition):
+   if not isinstance(condition, dict):
+      return value == condition
+
+   for operator, operand in condition.items():
+      if operator == '$in' and value not in operand:
+         return False
+      if operator == '$nin' and value in operand:
+         return False
+
+   return True
+
+def match_document(document, query):
+   for key, condition in query.items():
+      if isinstance(condition, dict) and '$elemMatch' in condition:
+         if not any(all(match_value(element.get(field), field_condition) for field, field_condition in condition['$elemMatch'].items())
+                    for element in document.get(key, [])):
+            return False
+      elif not match_value(document.get(key), condition):
+         return False
+
+   return True
+
+class FakeCursor(object):
+   def __init__(self, documents):
+      self.documents = documents
+
+   def sort(self, key, direction=1):
+      self.documents.sort(key=lambda document: document.get(key), reverse=direction < 0)
+      return self
+
+   def __iter__(self):
+      return iter(self.documents)
+
+class FakeCollection(object):
+   def __init__(self, documents):
+      self.documents = documents
+
+   def find(self, query, projection=None, batch_size=None):
+      result = []
+      for document in self.documents:
+         if match_document(document, query):
+            if projection:
+               document = dict([(key, value) for key, value in document.items() if key == '_id' or key in projection])
+            result.append(document)
+
+      return FakeCursor(result)
+
+   def create_index(self, keys, name=None):
+      return name
+
+class FakeMongoClient(object):
+   def __init__(self, indicators, samples):
+      from bson.objectid import ObjectId
+      for document in indicators + samples:
+         document['_id'] = ObjectId(document['_id'])
+      for document in indicators:
+         for rel in document['relationships']:
+            rel['value'] = str(rel['value'])
+
+      self.database = { 'indicators': FakeCollection(indicators), 'sample': FakeCollection(samples) }
+
+   def __getitem__(self, name):
+      return self
+
+   def __getattr__(self, name):
+      return self.database[name]
+
+   def close(self):
+      pass
+
+#
+# in-memory stand-in for the SIP API (pysip.Client)
+#
+
+class FakeSipClient(object):
+   def __init__(self, indicators):
+      self.indicators = []
+      for index, document in enumerate(indicators):
+         self.indicators.append({ 'id': index + 1, 'type': document['type'], 'value': document['value'], 'status': document['status'],
+                                  'references': [ { 'source': source['name'] } for source in document['source'] ],
+                                  'modified': '2020-01-01 00:00:00' })
+
+   # gives a share of the indicators a new value now, some of them are no longer exported
+   def modify(self, share, seed=0):
+      from indicator_store import TIMESTAMP_FORMAT
+      rnd = random.Random(seed)
+      modified = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+      for item in rnd.sample(self.indicators, max(int(len(self.indicators) * share), 1)):
+         item['value'] = VALUE_GENERATORS[item['type']](rnd)
+         item['status'] = 'Analyzed' if rnd.random() < 0.9 else 'New'
+         item['modified'] = modified
+
+   def get(self, endpoint):
+      path, _, query = endpoint.partition('?')
+      params = dict([(key, values[0]) for key, values in parse_qs(query, keep_blank_values=True).items()])
+      not_sources = set([x for x in params.get('not_sources', '').split(',') if x])
+
+      items = []
+      for item in self.indicators:
+         if 'type' in params and item['type'] != params['type']:
+            continue
+         if 'status' in params and item['status'] != params['status']:
+            continue
+         if 'modified_after' in params and item['modified'] <= params['modified_after']:
+            continue
+         sources = set([ref['source'] for ref in item['references']])
+         if not sources.isdisjoint(not_sources):
+            continue
+         if params.get('sources') and params['sources'] not in sources:
+            continue
+         items.append(item)
+
+      page = int(params.get('page', 1))
+      per_page = int(params.get('per_page', 1000))
+      result = { 'items': items[(page - 1) * per_page:page * per_page], '_links': {}, '_meta': { 'total_items': len(items) } }
+      if page * per_page < len(items):
+         params['page'] = page + 1
+         result['_links']['next'] = '/api/{0}?{1}'.format(path, urlencode(params))
+
+      return result
+
+   def close(self):
+      pass
+
+#
+# running a case
+#
+
+def get_config(output_dir, overrides):
+   config = ConfigParser()
+   config.read(os.path.join(REPO_DIR, 'etc', 'detect_export.ini'))
+   config['global']['template_dir'] = os.path.join(REPO_DIR, 'templates')
+   config['global']['compiled_rules'] = ''
+   config['sources']['not'] = 'excluded'
+   for option in ('rule_dir', 'splunk_lookup_table_dir', 'ssdeep_dir'):
+      config['global'][option] = os.path.join(output_dir, option)
+      os.makedirs(config['global'][option], exist_ok=True)
+
+   for override in overrides:
+      name, value = override.split('=', 1)
+      section, option = name.split('.', 1)
+      if not config.has_section(section):
+         config.add_section(section)
+      config[section][option] = value
+
+   return config
+
+# another tenant that only exports the indicators of one source to its own lookup tables
+def get_tenant_config(output_dir, overrides, source):
+   config = get_config(os.path.join(output_dir, source), overrides)
+   config['sources']['only'] = source
+   return config
+
+def get_output_bytes(output_dir):
+   total = 0
+   for directory, dirnames, filenames in os.walk(output_dir):
+      for filename in filenames:
+         total += os.path.getsize(os.path.join(directory, filename))
+   return total
+
+# adds up the seconds spent in each stage of a run, a stage that starts inside another one pauses
+# it so every second is counted once and the stages add up to the time of the whole run
+# only ever used from a single thread
+class StageTimer(object):
+   def __init__(self):
+      self.seconds = defaultdict(float)
+      self.stages = []
+      self.started = None
+
+   @contextmanager
+   def stage(self, name):
+      now = time.perf_counter()
+      if self.stages:
+         self.seconds[self.stages[-1]] += now - self.started
+      self.stages.append(name)
+      self.started = now
+      try:
+         yield
+      finally:
+         now = time.perf_counter()
+         self.seconds[self.stages.pop()] += now - self.started
+         self.started = now
+
+   # returns function counted as the stage
+   def wrap(self, function, name):
+      def timed(*args, **kwargs):
+         with self.stage(name):
+            return function(*args, **kwargs)
+      return timed
+
+   # yields the items of iterator, getting each one is counted as the stage
+   def wrap_iter(self, iterator, name):
+      iterator = iter(iterator)
+      while True:
+         with self.stage(name):
+            try:
+               item = next(iterator)
+            except StopIteration:
+               return
+         yield item
+
+# the stages are counted while the export runs, in this thread only
+#   fetch:     the stand-ins finding the indicators and the sources reading them (metrics.iter_timed)
+#   store:     the SIP indicator store saving and reading the indicators
+#   normalize: the variants of the values for the yara strings and lookup table rows
+#   render:    finishing each type, formatting its rules or lookup rows into its output
+#   write:     replacing the output files and finishing the sinks (all_indicators, compiled rules and
+#              waiting for the render workers if there are any)
+#   other:     everything else, mostly the sinks taking each indicator as it arrives
+STAGES = ['fetch', 'store', 'normalize', 'render', 'write', 'other']
+
+# the types are fetched one after another in this thread instead of in the fetch threads so the
+# stages do not overlap, the stand-ins answer from memory so the threads would not make it faster
+def fetch_types_in_order(fetch, indicator_types, max_workers=None):
+   for indicator_type in indicator_types:
+      yield indicator_type, fetch(indicator_type)
+
+def instrument(timer):
+   import export_engine
+   import export_metrics
+   import export_output
+   import indicator_store
+   import splunk_lookup
+   import yara_rules
+
+   export_engine.fetch_types = fetch_types_in_order
+
+   iter_timed = export_metrics.RunMetrics.iter_timed
+   export_metrics.RunMetrics.iter_timed = lambda self, iterator, *args: timer.wrap_iter(iter_timed(self, iterator, *args), 'fetch')
+
+   for name in ('replace_type', 'apply_delta'):
+      setattr(indicator_store.IndicatorStore, name, timer.wrap(getattr(indicator_store.IndicatorStore, name), 'store'))
+   iter_type = indicator_store.IndicatorStore.iter_type
+   indicator_store.IndicatorStore.iter_type = lambda self, *args: timer.wrap_iter(iter_type(self, *args), 'store')
+
+   iter_yara_variants = yara_rules.iter_yara_variants
+   yara_rules.iter_yara_variants = lambda *args: timer.wrap_iter(iter_yara_variants(*args), 'normalize')
+   for mode, (header, lookup_keys) in list(splunk_lookup.LOOKUP_MODES.items()):
+      splunk_lookup.LOOKUP_MODES[mode] = (header, timer.wrap(lookup_keys, 'normalize'))
+
+   for sink_class in export_engine.SINKS.values():
+      sink_class.finish_type = timer.wrap(sink_class.finish_type, 'render')
+      sink_class.finish = timer.wrap(sink_class.finish, 'write')
+   export_output.is_same_content = timer.wrap(export_output.is_same_content, 'write')
+   export_output.fsync_path = timer.wrap(export_output.fsync_path, 'write')
+
+# runs a single case in this process and returns its results
+def run_case(case, size, mix, seed, overrides):
+   import export_engine
+
+   source_name, sink_names, options = CASES[case]
+   indicators, samples = generate_corpus(size, mix, seed)
+   if source_name == 'crits':
+      client = FakeMongoClient(indicators, samples)
+      export_engine.MongoClient = lambda *args, **kwargs: client
+   else:
+      client = FakeSipClient(indicators)
+      export_engine.get_sip_client = lambda config: client
+
+   timer = StageTimer()
+   instrument(timer)
+
+   with tempfile.TemporaryDirectory(prefix='benchmark.') as output_dir:
+      config = get_config(output_dir, overrides)
+      tenants = [config] + [get_tenant_config(output_dir, overrides, source) for source in SOURCES[:options.get('tenants', 1) - 1]]
+      source_options = {}
+      if options.get('delta'):
+         source_options['indicator_store'] = os.path.join(output_dir, 'indicators.db')
+         source = export_engine.open_source(config, source_name, tenants, **source_options)
+         try:
+            export_engine.run_export(config, source_name, sink_names, source, tenants)
+         finally:
+            source.close()
+
+         client.modify(DELTA_SHARE, seed)
+         timer.seconds.clear()
+
+      start = time.perf_counter()
+      with timer.stage('other'):
+         source = export_engine.open_source(config, source_name, tenants, **source_options)
+         try:
+            export_engine.run_export(config, source_name, sink_names, source, tenants)
+         finally:
+            source.close()
+      seconds = time.perf_counter() - start
+      output_bytes = get_output_bytes(output_dir)
+
+   result = {
+      'case': case,
+      'indicators': size,
+      'seconds': seconds,
+      'rows_per_second': size / seconds if seconds else 0,
+      # kilobytes on linux
+      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+      'output_bytes': output_bytes,
+   }
+   for stage in STAGES:
+      result[stage] = timer.seconds[stage]
+
+   return result
+
+# runs a case in a new process so the peak RSS only covers the case
+def run_case_process(case, args):
+   command = [sys.executable, os.path.abspath(__file__), '--run-case', case, '--size', str(args.size), '--mix', args.mix, '--seed', str(args.seed)]
+   for override in args.overrides:
+      command.extend(['--set', override])
+
+   result = subprocess.run(command, stdout=subprocess.PIPE, check=True, cwd=REPO_DIR, universal_newlines=True)
+   return json.loads(result.stdout.strip().splitlines()[-1])
+
+def format_change(value, baseline_value):
+   if not baseline_value:
+      return ''
+   return '{0:+.1f}%'.format((value - baseline_value) * 100.0 / baseline_value)
+
+def print_results(results, baseline):
+   print('{0:<18} {1:>10} {2:>8} {3:>10} {4:>8} {5:>8} {6:>9} {7:>8} {8:>8} {9:>8} {10:>9} {11:>12} {12:>9}'.format(
+      'case', 'indicators', 'seconds', 'rows/sec', 'fetch', 'store', 'normalize', 'render', 'write', 'other', 'rss MB', 'output bytes', 'vs base'))
+   for result in results:
+      print('{case:<18} {indicators:>10} {seconds:>8.2f} {rows_per_second:>10.0f} {fetch:>8.2f} {store:>8.2f} {normalize:>9.2f} {render:>8.2f} '
+            '{write:>8.2f} {other:>8.2f} {peak_rss_mb:>9.1f} {output_bytes:>12}'.format(**result) + ' {0:>9}'.format(
+            format_change(result['rows_per_second'], baseline.get(result['case'], {}).get('rows_per_second'))))
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Benchmarks the exports against a synthetic indicator corpus.")
+   parser.add_argument('--case', action='append', choices=sorted(CASES), dest='cases',
+      help="Case to run. Specify more than once to run several. Defaults to every case.")
+   parser.add_argument('--size', type=int, default=10000, dest='size',
+      help="Number of indicators in the corpus.")
+   parser.add_argument('--mix', default='default', choices=sorted(MIXES), dest='mix',
+      help="Mix of indicator types in the corpus.")
+   parser.add_argument('--seed', type=int, default=0, dest='seed',
+      help="Seed of the corpus, the same seed and size always generate the same corpus.")
+   parser.add_argument('--set', action='append', default=[], dest='overrides', metavar='SECTION.OPTION=VALUE',
+      help="Override an option of etc/detect_export.ini.")
+   parser.add_argument('--baseline', default=DEFAULT_BASELINE, dest='baseline_path',
+      help="Results to compare against.")
+   parser.add_argument('--save-baseline', default=False, action='store_true', dest='save_baseline',
+      help="Save the results as the baseline.")
+   parser.add_argument('--run-case', default=None, dest='run_case', help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   logging.basicConfig(level=logging.ERROR)
+
+   if args.run_case:
+      print(json.dumps(run_case(args.run_case, args.size, args.mix, args.seed, args.overrides)))
+      sys.exit(0)
+
+   baseline = {}
+   if os.path.exists(args.baseline_path):
+      with open(args.baseline_path, 'r') as fp:
+         baseline = json.load(fp)
+
+   results = []
+   for case in args.cases or sorted(CASES):
+      results.append(run_case_process(case, args))
+
+   print_results(results, baseline)
+
+   if args.save_baseline:
+      directory = os.path.dirname(args.baseline_path)
+      if directory and not os.path.isdir(directory):
+         os.makedirs(directory)
+
+      with open(args.baseline_path, 'w') as fp:
+         json.dump(dict([(result['case'], result) for result in results]), fp, indent=3, sort_keys=True)
@@ -1,46 +1,10 @@
-#!/usr/bin/env python
-import os
-import argparse
-from configparser import ConfigParser
-import pprint
+#!/usr/bin/env python3
+# vim: ts=3:sw=3:et
 
-from pymongo import MongoClient
-from bson.objectid import ObjectId
-from bson.json_util import dumps
+# Exports ssdeep CRITS indicators into json, gets loaded into ACE.
+# This is detect_export.py with only the ssdeep json, see export_engine.py
 
-parser = argparse.ArgumentParser(description="Exports ssdeep CRITS indicators into json, gets loaded into ACE.")
-parser.add_argument('-c', '--config', default='etc/detect_export.ini', dest='config_path',
-    help="Configuration file to load.")
-args = parser.parse_args()
+from detect_export import get_parser, main
 
-config = ConfigParser()
-config.read(args.config_path)
-
-client = MongoClient('localhost', 27017)
-db = client.crits
-
-allsources = db.indicators.distinct('source.name')
-sources = []
-not_sources = config['sources']['not']
-not_mimetypes = "application/vnd.ms-excel,application/vnd.ms-office,application/msword,application/CDFV2-corrupt"
-for src in allsources:
-    if src and src not in not_sources:
-       sources.append(src)
-print(sources)
-
-collection = db.indicators.find({"status":"Analyzed",'type':'Hash - SSDEEP',"source.name":{"$in":sources}})
-
-data = { 'objects' : [] }
-for row in collection:
-    relationships = row['relationships']
-    
-    for rel in relationships:
-       samples = db.sample.find({'_id':ObjectId(rel['value'])})
-       for sample in samples:
-          if sample['mimetype'] not in not_mimetypes:
-             data['objects'].append( { 'id' : str(row['_id']), 'ssdeep' : row['value'], 'tags' : row['bucket_list'], 'campaigns' : row['campaign'] } )
-
-final_data = dumps(data)
-
-with open(config.get('global','ssdeep_dir') + "/ssdeep.json", 'w') as outfile:
-    outfile.write(final_data)
+if __name__ == "__main__":
+   main(get_parser("Exports ssdeep CRITS indicators into json, gets loaded into ACE.").parse_args(), 'crits', ['ssdeep'])
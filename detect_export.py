@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# vim: ts=3:sw=3:et
+
+import argparse
+import logging
+import os
+import os.path
+import sys
+
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+
+from export_engine import DEFAULT_SINKS, SINKS, SOURCES, ensure_indexes, open_source, run_export
+from export_logging import init_logging
+from export_metrics import write_metrics
+from export_output import write_changed_files
+
+# the options every export script takes
+def get_parser(description, default_config='etc/detect_export.ini'):
+   parser = argparse.ArgumentParser(description=description)
+   parser.add_argument('-c', '--config', action='append', dest='config_paths',
+      help="Configuration file to load, defaults to {0}. Specify more than once to export the splunk lookup "
+      "tables of several tenants from a single read of the indicators, the first one is used for "
+      "everything else.".format(default_config))
+   parser.set_defaults(default_config_path=default_config)
+   parser.add_argument('--changed-files', dest='changed_files_path', default=None,
+      help="Write the paths of the output files that changed to this file, one per line.")
+   parser.add_argument('--ensure-indexes', default=False, action='store_true', dest='ensure_indexes',
+      help="Create the CRITS indexes the exports use (if they do not exist) and exit.")
+   parser.add_argument('--full', default=False, action='store_true', dest='full',
+      help="Ignore the local indicator store (if the export keeps one) and download every indicator again.")
+   return parser
+
+# indicator_store is the default path of the local SIP indicator store ([global] indicator_store moves it),
+# None to download every indicator every time
+# the export is skipped unless an indicator was modified in the last changed_within minutes
+def main(args, source_name, sink_names, indicator_store=None, changed_within=None):
+   # load configuration, one for every tenant
+   tenants = []
+   for config_path in args.config_paths or [args.default_config_path]:
+      tenant_config = ConfigParser()
+      tenant_config.read(config_path)
+      tenants.append(tenant_config)
+
+   config = tenants[0]
+
+   # initialize logging
+   init_logging(config)
+
+   if args.ensure_indexes:
+      if source_name != 'crits':
+         logging.error("only CRITS has indexes to create")
+         sys.exit(1)
+
+      ensure_indexes(config)
+      return
+
+   options = {}
+   if indicator_store:
+      options = { 'indicator_store': config.get('global', 'indicator_store', fallback=indicator_store), 'full': args.full }
+
+   source = open_source(config, source_name, tenants, **options)
+   try:
+      if changed_within is not None and not source.has_changes(datetime.utcnow() - timedelta(minutes=changed_within)):
+         logging.info("no indicators changed in the last {0} minutes".format(changed_within))
+         return
+
+      run_export(config, source_name, sink_names, source, tenants)
+
+   finally:
+      source.close()
+
+   if args.changed_files_path:
+      write_changed_files(args.changed_files_path)
+
+   # the metrics are named after the script that was run
+   write_metrics(config, os.path.splitext(os.path.basename(sys.argv[0]))[0])
+
+if __name__ == "__main__":
+   parser = get_parser("Exports indicators into yara rules, splunk lookup tables and ssdeep json from a single read of the indicators.")
+   parser.add_argument('-s', '--source', default='crits', choices=sorted(SOURCES), dest='source',
+      help="Where to read the indicators from.")
+   parser.add_argument('--sink', action='append', choices=sorted(SINKS), dest='sinks',
+      help="What to export the indicators to. Specify more than once to export to several. "
+      "Defaults to everything the source supports.")
+   args = parser.parse_args()
+
+   main(args, args.source, args.sinks or DEFAULT_SINKS[args.source])
@@ -6,27 +6,38 @@ then
     export DETECT_EXPORTS=/opt/detect_exports
 fi
 
+cd "${DETECT_EXPORTS}" || exit 1
+
+# the exporter lists the output files it changed here, nothing gets committed if nothing changed
+CHANGED_FILES=$(mktemp) || exit 1
+trap 'rm -f "${CHANGED_FILES}"' EXIT
+
+# the yara rules are not exported again until the compile error is fixed
+SINKS="--sink splunk --sink ssdeep"
+if [ ! -e YARA_COMPILE_ERROR ]
+then
+    SINKS="${SINKS} --sink yara"
+else
+    echo "YARA_COMPILE_ERROR!!!"
+fi
+
+# every output is exported from a single read of the CRITS indicators
+python3 detect_export.py -c etc/detect_export.ini ${SINKS} --changed-files "${CHANGED_FILES}"
+
 ####################################################################################
 ##### CSV / Splunk Lookup Table Exports ##################################################
 ####################################################################################
-cd "${DETECT_EXPORTS}" || exit 1
-
-python3 crits_export_splunk.py -c etc/detect_export.ini
-(cd "${DETECT_EXPORTS}/splunk_lookup_tables" && git add *.csv > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
 
-cd "${DETECT_EXPORTS}"
+grep -q "splunk_lookup_tables/" "${CHANGED_FILES}" && (cd "${DETECT_EXPORTS}/splunk_lookup_tables" && git add -A . > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
 
-python3 crits_export_ssdeep.py -c etc/detect_export.ini
-(cd "${DETECT_EXPORTS}/crits_ssdeep" && git add *.json > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
+grep -q "crits_ssdeep/" "${CHANGED_FILES}" && (cd "${DETECT_EXPORTS}/crits_ssdeep" && git add -A . > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
 
 ####################################################################################
 ##### Yara Rule Intel Exports     ##################################################
 ####################################################################################
 
-if [ ! -e YARA_COMPILE_ERROR ]
+if [ ! -e YARA_COMPILE_ERROR ] && grep -q "crits_yara_rules/" "${CHANGED_FILES}"
 then
-    python3 crits_export_yara.py -c etc/detect_export.ini
-
     # make sure the yara rules compile
     if ! /usr/local/bin/scan -c -Y crits_yara_rules
     then
@@ -37,7 +48,5 @@ then
         exit 1
     fi
 
-    ( cd "${DETECT_EXPORTS}/crits_yara_rules" && git add *.yar > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
-else
-    echo "YARA_COMPILE_ERROR!!!"
+    ( cd "${DETECT_EXPORTS}/crits_yara_rules" && git add -A . > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
 fi
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# vim: ts=3:sw=3:et
+
+import argparse
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import os.path
+import random
+import signal
+import subprocess
+import tempfile
+import time
+
+from configparser import ConfigParser
+from datetime import datetime
+
+from export_engine import DEFAULT_SINKS, SINKS, SOURCES, open_source, run_export
+from export_logging import init_logging, init_worker_logging
+from export_metrics import metrics, write_metrics
+from export_output import changed_files, reset_changed_files, write_changed_files
+
+# Runs the exports on a schedule instead of starting them from cron.
+#
+# Every job runs in its own worker process that is started once and keeps its
+# configuration, connection to CRITS or SIP and yara templates between runs.
+# A run is skipped when the previous run of the job is still going, and jobs
+# that write to the same outputs never run at the same time.
+#
+# Like detect_export.py a job can export the splunk lookup tables of several
+# tenants from a single read of the indicators, and a SIP job can keep a local
+# indicator store so every run only downloads what changed since the last one.
+#
+# [job:<name>]
+# ; the exporter configuration, the same as detect_export.py takes, a comma separated
+# ; list exports the splunk lookup tables of every tenant, the first one is used for everything else
+# config = etc/detect_export.ini
+# ; where the indicators are read from and what they are exported to, each sink needs
+# ; its directory (rule_dir, splunk_lookup_table_dir, ssdeep_dir) in the exporter configuration
+# source = crits
+# sinks = yara, splunk, ssdeep
+# ; optional path of the local indicator store of a SIP job (see indicator_store.py)
+# indicator_store =
+# ; seconds between the starts of two runs
+# interval = 900
+# ; up to this many random seconds are added to every interval so the jobs spread out
+# jitter = 60
+# ; optional command (run with the shell) after a run that changed files, the
+# ; CHANGED_FILES environment variable is the path of the list of changed files
+# post_command =
+
+# how often (seconds) the scheduler checks if it was asked to stop
+POLL_SECONDS = 1
+
+# the value of an option in [global] that names an output, it has to be set
+def get_output(config, option):
+   output = config.get('global', option, fallback='')
+   if not output:
+      raise ValueError("[global] {0} is not set in the exporter configuration".format(option))
+   return output
+
+# the files and directories the sinks of a job write to
+def get_outputs(config, sink_names, tenants=None, indicator_store=None):
+   outputs = []
+   if 'yara' in sink_names:
+      outputs.append(get_output(config, 'rule_dir'))
+      if config.get('global', 'compiled_rules', fallback=''):
+         outputs.append(config['global']['compiled_rules'])
+   if 'splunk' in sink_names:
+      for tenant_config in tenants or [config]:
+         outputs.append(get_output(tenant_config, 'splunk_lookup_table_dir'))
+   if 'ssdeep' in sink_names:
+      outputs.append(get_output(config, 'ssdeep_dir'))
+   if config.get('metrics', 'prometheus_file', fallback=''):
+      outputs.append(config['metrics']['prometheus_file'])
+   if indicator_store:
+      outputs.append(indicator_store)
+
+   return set([os.path.abspath(output) for output in outputs])
+
+def is_same_output(path, other_path):
+   return path == other_path or path.startswith(other_path + os.sep) or other_path.startswith(path + os.sep)
+
+class ExportJob(object):
+   def __init__(self, name, section):
+      self.name = name
+      self.tenants = []
+      for config_path in section['config'].split(','):
+         tenant_config = ConfigParser()
+         tenant_config.read(config_path.strip())
+         self.tenants.append(tenant_config)
+
+      self.config = self.tenants[0]
+      self.source_name = section.get('source', 'crits')
+      if self.source_name not in SOURCES:
+         raise ValueError("job {0} has an invalid source {1}".format(name, self.source_name))
+
+      # passed to the source when it is opened
+      self.source_options = {}
+      indicator_store = section.get('indicator_store', fallback='')
+      if indicator_store:
+         if self.source_name != 'sip':
+            raise ValueError("job {0} has an indicator_store but only SIP jobs keep one".format(name))
+         self.source_options['indicator_store'] = indicator_store
+
+      self.sink_names = [sink_name.strip() for sink_name in section.get('sinks', '').split(',') if sink_name.strip()] \
+                        or DEFAULT_SINKS[self.source_name]
+      for sink_name in self.sink_names:
+         if sink_name not in SINKS:
+            raise ValueError("job {0} has an invalid sink {1}".format(name, sink_name))
+
+      self.interval = section.getfloat('interval', fallback=900)
+      self.jitter = section.getfloat('jitter', fallback=0)
+      self.post_command = section.get('post_command', fallback='')
+      try:
+         self.outputs = get_outputs(self.config, self.sink_names, self.tenants, indicator_store)
+      except ValueError as e:
+         raise ValueError("job {0} can not export to {1}: {2}".format(name, ', '.join(self.sink_names), str(e)))
+
+      self.process = None
+      self.connection = None
+      self.active = False
+      self.next_run = None
+
+   def shares_outputs(self, other):
+      return any([is_same_output(path, other_path) for path in self.outputs for other_path in other.outputs])
+
+   def schedule(self, now):
+      self.next_run = now + self.interval + random.uniform(0, self.jitter)
+
+   # the worker is forked so it starts with everything this process has already imported and read
+   def start(self, context):
+      self.connection, worker_connection = context.Pipe()
+      self.process = context.Process(target=run_job_worker, args=(self, worker_connection), name='job-{0}'.format(self.name))
+      self.process.start()
+      worker_connection.close()
+      self.active = False
+
+   def run(self):
+      self.connection.send(True)
+      self.active = True
+
+   def stop(self):
+      try:
+         self.connection.send(None)
+      except OSError:
+         pass
+
+# runs the post_command of the job with the list of the files the run changed
+def run_post_command(job):
+   fd, changed_files_path = tempfile.mkstemp(prefix='{0}.'.format(job.name), suffix='.changed')
+   os.close(fd)
+   try:
+      write_changed_files(changed_files_path)
+      logging.info("running {0} for {1}".format(job.post_command, job.name))
+      result = subprocess.run(job.post_command, shell=True, env=dict(os.environ, CHANGED_FILES=changed_files_path))
+      if result.returncode != 0:
+         logging.error("{0} for {1} failed with exit code {2}".format(job.post_command, job.name, result.returncode))
+   finally:
+      os.remove(changed_files_path)
+
+# exports once, returns the status of the run
+def run_job_once(job, source, last_started):
+   # there is nothing to export if nothing changed since the previous run started
+   if last_started is not None and hasattr(source, 'has_changes') and not source.has_changes(last_started):
+      logging.info("no indicators changed since the last run of {0}".format(job.name))
+      return 'unchanged'
+
+   run_export(job.config, job.source_name, job.sink_names, source, job.tenants)
+   write_metrics(job.config, job.name)
+   if job.post_command and changed_files:
+      run_post_command(job)
+
+   return 'exported'
+
+# the worker process of a job, exports every time the scheduler asks until it is told to stop
+def run_job_worker(job, connection):
+   # the scheduler decides when the workers stop so a run is not interrupted
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+   signal.signal(signal.SIGTERM, signal.SIG_IGN)
+   init_worker_logging()
+
+   source = None
+   last_started = None
+   try:
+      while connection.recv():
+         started = datetime.utcnow()
+         start = time.perf_counter()
+         reset_changed_files()
+         metrics.reset()
+         try:
+            # the connection is kept for the next run unless something went wrong
+            if source is None:
+               source = open_source(job.config, job.source_name, job.tenants, **job.source_options)
+
+            status = run_job_once(job, source, last_started)
+            last_started = started
+         except Exception as e:
+            logging.exception("run of {0} failed: {1}".format(job.name, str(e)))
+            status = 'failed'
+            if source is not None:
+               try:
+                  source.close()
+               except Exception:
+                  pass
+               source = None
+
+         connection.send({ 'status': status, 'seconds': time.perf_counter() - start, 'changed': len(changed_files) })
+
+   except EOFError:
+      pass
+
+   finally:
+      if source is not None:
+         source.close()
+
+def load_jobs(config):
+   jobs = []
+   for section_name in config.sections():
+      if section_name.startswith('job:'):
+         jobs.append(ExportJob(section_name[len('job:'):], config[section_name]))
+
+   if not jobs:
+      raise ValueError("no [job:<name>] sections are configured")
+
+   return jobs
+
+# starts every job when it is due until it is told to stop (SIGTERM or SIGINT)
+def run_daemon(jobs, stop_timeout):
+   stopping = []
+   def stop(signum, frame):
+      logging.info("stopping after signal {0}".format(signum))
+      stopping.append(signum)
+
+   context = multiprocessing.get_context('fork')
+   now = time.monotonic()
+   for job in jobs:
+      job.start(context)
+      # the first runs are spread out as well
+      job.next_run = now + random.uniform(0, job.jitter)
+      logging.info("job {0} exports from {1} to {2} every {3} seconds".format(job.name, job.source_name, ', '.join(job.sink_names), job.interval))
+
+   signal.signal(signal.SIGINT, stop)
+   signal.signal(signal.SIGTERM, stop)
+
+   try:
+      while not stopping:
+         now = time.monotonic()
+         for job in sorted(jobs, key=lambda job: job.next_run):
+            if job.next_run > now:
+               continue
+
+            if job.active:
+               logging.warning("skipping a run of {0}, the previous run is still going".format(job.name))
+               job.schedule(now)
+               continue
+
+            # the job stays due until whatever is writing to the same outputs finishes
+            if any([other.active and job.shares_outputs(other) for other in jobs if other is not job]):
+               continue
+
+            logging.info("starting {0}".format(job.name))
+            job.run()
+            job.schedule(now)
+
+         waiting = [job.next_run - now for job in jobs if job.next_run > now]
+         timeout = min(waiting + [POLL_SECONDS])
+         active = dict([(job.connection, job) for job in jobs if job.active])
+         for connection in multiprocessing.connection.wait(list(active), timeout):
+            job = active[connection]
+            job.active = False
+            try:
+               result = connection.recv()
+            except EOFError:
+               logging.error("the worker of {0} exited (exit code {1}), starting it again".format(job.name, job.process.exitcode))
+               job.process.join()
+               job.start(context)
+               continue
+
+            log = logging.error if result['status'] == 'failed' else logging.info
+            log("run of {0} {1} in {2:.2f} seconds, {3} files changed".format(job.name, result['status'], result['seconds'], result['changed']))
+
+         if not active:
+            time.sleep(timeout)
+
+   finally:
+      for job in jobs:
+         job.stop()
+
+      deadline = time.monotonic() + stop_timeout
+      for job in jobs:
+         job.process.join(max(0, deadline - time.monotonic()))
+         if job.process.is_alive():
+            logging.error("{0} did not finish within {1} seconds, killing it".format(job.name, stop_timeout))
+            job.process.kill()
+            job.process.join()
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Runs the exports on a schedule.")
+   parser.add_argument('-c', '--config', default='etc/export_daemon.ini', dest='config_path',
+      help="Configuration file to load.")
+   args = parser.parse_args()
+
+   config = ConfigParser()
+   config.read(args.config_path)
+
+   # initialize logging
+   init_logging(config)
+
+   run_daemon(load_jobs(config), config.getfloat('global', 'stop_timeout', fallback=600))
@@ -0,0 +1,709 @@
+# vim: ts=3:sw=3:et
+
+import io
+import json
+import logging
+import os
+import os.path
+import shutil
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import as_completed
+from datetime import datetime
+from itertools import groupby
+
+from export_metrics import metrics
+from export_output import atomic_write, get_sorted_output, remove_output, WRITE_BUFFER_SIZE
+from indicator_source import CRITS_PROJECTION, ensure_crits_indexes, explain_crits_query, fetch_types, get_fetch_workers, get_page_size, \
+                             iter_crits_indicators, iter_sip_indicators
+from indicator_store import get_sync_overlap, IndicatorStore, TIMESTAMP_FORMAT
+from source_filter import SourceFilter, get_sip_sources
+from splunk_kvstore import sync_kvstore
+from splunk_lookup import get_lookup_header, get_lookup_keys, get_lookup_suffix, LookupRows, read_lookup_file, write_lookup_file, write_lookup_table
+from yara_rules import get_compiled_rules, get_max_strings, get_render_executor, get_validate_rules, render_rules, render_rules_text, save_compiled_rules, TemplateCache
+
+# only the client library of the source that is used needs to be installed
+try:
+   from bson.json_util import dumps
+   from bson.objectid import ObjectId
+   from pymongo import MongoClient
+except ImportError:
+   MongoClient = None
+
+try:
+   from sip_client import get_sip_client
+except ImportError:
+   get_sip_client = None
+
+# Reads the indicators of every type once from a source and hands them to every
+# sink that exports the type, so exporting to yara, splunk and ssdeep is a single
+# read of the indicators instead of one per output.
+#
+# A source calls export_type(indicator type, indicators) from fetch(types, fields,
+# export_type) for every type, where indicators is an iterator that yields each
+# indicator as it is downloaded as a dict with at least id, type and value plus the
+# fields asked for.  The SIP source calls it from several threads at once, one type
+# per thread.  A sink lists the types it exports (types) and the fields it needs
+# (fields).  For each type start_type() returns the function every indicator is
+# passed to and finish_type() is called after the last one, anything that covers
+# all of the types is written in finish().  The indicators are not kept around so
+# only the sinks that need every indicator of a type at once (to sort them, render
+# rules or look up samples) hold on to them.  The indicators are shared between
+# the sinks and must not be modified.
+#
+# The SIP source can keep the indicators in a local IndicatorStore, then only the
+# indicators modified since the last run are downloaded and only the types that
+# changed (or whose outputs the sinks list in stale_types()) are exported.  The
+# sources commit() once every sink finished so a failed export is done again.
+#
+# The sinks run in a single export, so a sink that fails (including one that is
+# not configured) stops the export to every other sink as well and nothing is
+# committed.  Run the exports that should not depend on each other separately.
+#
+# The splunk sink can export the lookup tables of several tenants (one config
+# each) at once.  The source then reads everything any of the tenants exports
+# and the splunk sink filters the indicators of each tenant by their sources.
+
+# the indicator types exported to yara rules unless [global] included_types is set
+YARA_TYPES = ['Address - ipv4-addr', 'Antivirus - Streetname', 'Code - Binary_Code', 'Email - Address', 'Email - Content', 'Email - Subject', 'Email - Xmailer', 'IDS - Streetname', 'Persona', 'String - EPS',  'String - Java', 'String - JS', 'String - HTML','String - Office', 'String - PDF', 'String - PE', 'String - RTF', 'String - SWF', 'String - Windows Shell', 'String - Unix Shell', 'String - VBS', 'URI - Domain Name', 'URI - HTTP - UserAgent', 'URI - URL', 'URI - Path', 'Windows - FileName', 'Windows - FilePath', 'Windows - Hostname', 'Windows - Mutex', 'Windows - Registry', 'Windows - Service','Email Header Field','Email X-Originating IP']
+
+# the indicator types exported to splunk lookup tables
+SPLUNK_TYPES = ['Account',
+                'Address - ipv4-addr',
+                'Address - ipv4-net',
+                'Antivirus - Streetname',
+                'Hash - MD5',
+                'Hash - SHA1',
+                'Hash - SHA256',
+                'Email - Address',
+                'Email - Subject',
+                'Email - Xmailer',
+                'Email X-Originating IP',
+                'IDS - Streetname',
+                'URI - Domain Name',
+                'URI - HTTP - UserAgent',
+                'URI - URL',
+                'URI - Path',
+                'Windows - FileName',
+                'Windows - FilePath',
+                'Windows - Hostname',
+                'Windows - Registry',
+                'Windows - Service',
+                'String - Windows Shell',
+                'String - Unix Shell'
+               ]
+
+# ssdeep hashes are only exported if they are related to a sample that is not one of these
+SSDEEP_NOT_MIMETYPES = frozenset(["application/vnd.ms-excel","application/vnd.ms-office","application/msword","application/CDFV2-corrupt"])
+
+def sanitize(ind_type):
+   out = ind_type.replace(" ","")
+   out = out.replace("-","")
+   return out
+
+def get_yara_types(config):
+   excluded_types = []
+   if 'excluded_types' in config['global']:
+      excluded_types = [x.strip() for x in config['global']['excluded_types'].split(',')]
+
+   export_types = YARA_TYPES
+   if config.get('global', 'included_types', fallback=''):
+      export_types = [x.strip() for x in config['global']['included_types'].split(',')]
+
+   return [indicator_type for indicator_type in export_types if indicator_type not in excluded_types]
+
+# maps lower case indicator types to the string modifiers of their yara strings
+def get_string_modifiers(config):
+   string_modifiers = defaultdict(lambda: config['string_modifiers']['default'])
+   for indicator_type in config['string_modifiers']:
+      if indicator_type == 'default':
+         continue
+
+      string_modifiers[indicator_type] = config['string_modifiers'][indicator_type]
+      logging.debug("using string modifiers {} for {}".format(string_modifiers[indicator_type], indicator_type))
+
+   return string_modifiers
+
+class CritsSource(object):
+   # yara rules and files are named CRITS_<type>
+   rule_prefix = 'CRITS_'
+   strip_url_scheme = False
+   # prefix of the ids in the lookup tables
+   lookup_id_prefix = ''
+
+   def __init__(self, config, source_filter=None):
+      if MongoClient is None:
+         raise ImportError("pymongo is required to export from CRITS")
+
+      self.config = config
+      self.source_filter = source_filter or SourceFilter.from_config(config)
+      logging.debug("exporting indicators matching {0}".format(self.source_filter))
+      self.connection = MongoClient(config['crits']['uri'])
+      self.db = self.connection[config['crits']['db']]
+      # log how mongo runs every query (which runs them twice)
+      self.explain_queries = config.getboolean('crits', 'explain_queries', fallback=False)
+      # download every type at once instead of one query per type
+      self.single_query = config.getboolean('crits', 'single_query', fallback=False)
+
+   # returns the indicators that match the query, only the given fields are downloaded
+   def find(self, query, fields, sort=None):
+      # only the fields the sinks use
+      projection = dict(CRITS_PROJECTION)
+      projection.update([(field, True) for field in fields])
+      query = dict(query, **self.source_filter.mongo_query())
+      if self.explain_queries:
+         logging.debug("query {0} {1}".format(query, explain_crits_query(self.db, query, projection)))
+
+      cursor = iter_crits_indicators(self.db, query, projection, get_page_size(self.config))
+      if sort is not None:
+         cursor = cursor.sort(sort, 1)
+
+      for row in cursor:
+         row['id'] = str(row['_id'])
+         yield row
+
+   # the indicators are handed to the sinks while they download, fetch_seconds only counts the downloading
+   # every type is exported every time so stale types do not need to be
+   def fetch(self, types, fields, export_type, stale_types=()):
+      if not self.single_query:
+         for indicator_type in types:
+            export_type(indicator_type, metrics.iter_timed(self.find({"status":"Analyzed","type":indicator_type}, fields.get(indicator_type, [])),
+                                                           'fetch_seconds', indicator_type))
+         return
+
+      # a single query sorted by type for all of the types that need the same fields
+      groups = {}
+      for indicator_type in types:
+         groups.setdefault(frozenset(fields.get(indicator_type, [])), []).append(indicator_type)
+
+      for group_fields, group_types in groups.items():
+         logging.debug("downloading {0} indicator types in a single query".format(len(group_types)))
+         empty_types = set(group_types)
+         for indicator_type, rows in groupby(self.find({"status":"Analyzed","type":{"$in":group_types}}, group_fields, sort='type'),
+                                             key=lambda row: row['type']):
+            empty_types.discard(indicator_type)
+            export_type(indicator_type, metrics.iter_timed(rows, 'fetch_seconds', indicator_type))
+
+         # the sinks still need to know the types without indicators
+         for indicator_type in group_types:
+            if indicator_type in empty_types:
+               export_type(indicator_type, iter([]))
+
+   def commit(self):
+      pass
+
+   def rollback(self):
+      pass
+
+   def close(self):
+      self.connection.close()
+
+class SipSource(object):
+   rule_prefix = ''
+   strip_url_scheme = True
+   lookup_id_prefix = 'sip:'
+
+   # the names of the sources of an indicator
+   get_sources = staticmethod(get_sip_sources)
+
+   # indicator_store is the path of the local IndicatorStore, None to download every indicator every time
+   # full downloads every indicator into the store again
+   def __init__(self, config, source_filter=None, indicator_store=None, full=False):
+      if get_sip_client is None:
+         raise ImportError("pysip is required to export from SIP")
+
+      self.config = config
+      self.source_filter = source_filter or SourceFilter.from_config(config)
+      logging.debug("exporting indicators matching {0}".format(self.source_filter))
+      self.sip_client = get_sip_client(config)
+      self.store = IndicatorStore(indicator_store) if indicator_store else None
+      self.full = full
+      # what the store was synced with by the export that is running
+      self.sync_started = None
+      self.fingerprint = None
+
+   # yields the exportable indicators returned by a SIP query
+   def iter_query(self, query):
+      query = '{}&{}'.format(query, self.source_filter.sip_query())
+      for item in iter_sip_indicators(self.sip_client, query, get_page_size(self.config)):
+         if self.source_filter.sip_filters_all or self.source_filter.accepts(get_sip_sources(item)):
+            yield item
+
+   # yields the exportable indicators of a type
+   def iter_type(self, indicator_type):
+      return self.iter_query('indicators?type={}&status={}'.format(indicator_type, "Analyzed"))
+
+   # every type is downloaded at the same time, SIP returns every field
+   # without a store the indicators are handed to the sinks in the fetch threads while they download
+   def fetch(self, types, fields, export_type, stale_types=()):
+      if self.store is not None:
+         self.sync(types, export_type, stale_types)
+         return
+
+      def fetch_type(indicator_type):
+         export_type(indicator_type, metrics.iter_timed(self.iter_type(indicator_type), 'fetch_seconds', indicator_type))
+
+      for indicator_type, _ in fetch_types(fetch_type, types, get_fetch_workers(self.config)):
+         pass
+
+   # brings the store up to date and exports the types that changed from it
+   def sync(self, types, export_type, stale_types):
+      # the store has to be rebuilt if what we export changes
+      fingerprint = json.dumps({ 'types': sorted(types), 'sources': repr(self.source_filter) }, sort_keys=True)
+
+      # anything modified after this point gets picked up by the next run
+      sync_started = datetime.utcnow()
+      high_water_mark = self.store.high_water_mark()
+
+      if self.full or high_water_mark is None or self.store.get_state('fingerprint') != fingerprint:
+         logging.info("performing full sync of {0} indicator types".format(len(types)))
+         self.full_sync(types, export_type)
+      else:
+         changed_types = self.delta_sync(types, high_water_mark - get_sync_overlap(self.config))
+         if not changed_types:
+            logging.info("no changes since {0}".format(high_water_mark))
+
+         # the types whose outputs are gone or out of date are exported again from the store
+         for indicator_type in types:
+            if indicator_type in changed_types or (indicator_type in stale_types and self.store.has_type(indicator_type)):
+               export_type(indicator_type, self.store.iter_type(indicator_type))
+
+      self.sync_started = sync_started
+      self.fingerprint = fingerprint
+
+   # pulls every exportable indicator of every type into the store, exporting each type as it arrives
+   def full_sync(self, types, export_type):
+      def fetch_type(indicator_type):
+         logging.debug("downloading all indicators of type {0}".format(indicator_type))
+         self.store.replace_type(indicator_type, metrics.iter_timed(self.iter_type(indicator_type), 'fetch_seconds', indicator_type))
+
+      for indicator_type, _ in fetch_types(fetch_type, types, get_fetch_workers(self.config)):
+         export_type(indicator_type, self.store.iter_type(indicator_type))
+
+   # pulls only the indicators modified since the given time and applies them to the store
+   # returns the types that changed
+   def delta_sync(self, types, modified_after):
+      modified_after = modified_after.strftime(TIMESTAMP_FORMAT)
+      logging.debug("downloading indicators modified after {0}".format(modified_after))
+
+      # everything modified that should (still) be exported
+      exportable_ids = set()
+      def iter_modified_exportable():
+         for item in metrics.iter_timed(self.iter_query('indicators?modified_after={}&status={}'.format(modified_after, "Analyzed")), 'fetch_seconds'):
+            if item['type'] in types:
+               exportable_ids.add(int(item['id']))
+               yield item
+
+      # everything modified, anything not in the list above no longer gets exported
+      def iter_removed_ids():
+         for item in metrics.iter_timed(iter_sip_indicators(self.sip_client, 'indicators?modified_after={}'.format(modified_after), get_page_size(self.config)), 'fetch_seconds'):
+            if int(item['id']) not in exportable_ids:
+               yield item['id']
+
+      return self.store.apply_delta(iter_modified_exportable(), iter_removed_ids())
+
+   # the store only moves on to what was downloaded once everything was exported from it
+   def commit(self):
+      if self.store is None or self.fingerprint is None:
+         return
+
+      self.store.set_state('fingerprint', self.fingerprint)
+      self.store.set_high_water_mark(self.sync_started)
+      self.store.commit()
+      self.fingerprint = None
+      self.full = False
+
+   def rollback(self):
+      if self.store is not None:
+         self.store.rollback()
+      self.fingerprint = None
+
+   # whether any indicator was modified after the given (utc) datetime, only the first one is downloaded
+   # since is moved back by the same overlap as the delta syncs, the clocks of SIP and this host may differ
+   def has_changes(self, since):
+      since = since - get_sync_overlap(self.config)
+      query = 'indicators?modified_after={}'.format(since.strftime(TIMESTAMP_FORMAT))
+      return next(iter_sip_indicators(self.sip_client, query, 1), None) is not None
+
+   def close(self):
+      self.sip_client.close()
+      if self.store is not None:
+         self.store.close()
+
+class YaraSink(object):
+   fields = ()
+
+   def __init__(self, config, source):
+      self.config = config
+      self.source = source
+      self.types = get_yara_types(config)
+      self.rule_dir = config['global']['rule_dir']
+      if not os.path.isdir(self.rule_dir):
+         logging.debug("creating rules dir {0}".format(self.rule_dir))
+         os.makedirs(self.rule_dir)
+
+      self.templates = TemplateCache.load(config['global']['template_dir'])
+      self.string_modifiers = get_string_modifiers(config)
+      self.validate_rules = get_validate_rules(config)
+      # None when the rules are rendered in this process
+      self.renderer = get_render_executor(config)
+      # indicator type -> the indicators of the type that is downloading
+      self.indicators = {}
+      # indicator type -> future of render_rules_text() that has not been written yet
+      self.rendered = {}
+      # the fetch threads write the rendered types as well
+      self.lock = threading.Lock()
+
+   def get_filename(self, indicator_type):
+      return os.path.join(self.rule_dir, '{0}{1}.yar'.format(self.source.rule_prefix, sanitize(indicator_type)))
+
+   # the types whose rules are missing
+   def stale_types(self):
+      return set([indicator_type for indicator_type in self.types if not os.path.exists(self.get_filename(indicator_type))])
+
+   # the rules are rendered from all of the indicators of the type at once
+   def start_type(self, indicator_type):
+      self.indicators[indicator_type] = []
+      return self.indicators[indicator_type].append
+
+   def finish_type(self, indicator_type):
+      logging.debug("exporting indicator type {0}".format(indicator_type))
+      indicators = self.indicators.pop(indicator_type)
+      header, footer = self.templates.get(sanitize(indicator_type))
+      args = (header, footer, '{0}{1}'.format(self.source.rule_prefix, sanitize(indicator_type)), indicators,
+              self.string_modifiers[indicator_type.lower()])
+      kwargs = { 'strip_url_scheme': self.source.strip_url_scheme, 'max_strings': get_max_strings(self.config),
+                 'sort': get_sorted_output(self.config), 'validate': self.validate_rules }
+
+      # rendered straight into the rule file, the rules are never held in memory
+      if self.renderer is None:
+         output_file = self.get_filename(indicator_type)
+         with atomic_write(output_file) as fp:
+            stats = render_rules(fp, *args, **kwargs)
+         self.written(indicator_type, output_file, stats)
+         return
+
+      future = self.renderer.submit(render_rules_text, *args, **kwargs)
+      with self.lock:
+         self.rendered[indicator_type] = future
+
+      # every type has its own file so the rules are written as soon as they are rendered instead of keeping them until the end
+      with self.lock:
+         done = [(indicator_type, self.rendered.pop(indicator_type)) for indicator_type, future in list(self.rendered.items()) if future.done()]
+      for indicator_type, future in done:
+         self.write_type(indicator_type, future)
+
+   # writes the rules of an indicator type rendered in a worker process
+   def write_type(self, indicator_type, future):
+      rules, stats = future.result()
+      output_file = self.get_filename(indicator_type)
+      with atomic_write(output_file) as fp:
+         fp.write(rules)
+      self.written(indicator_type, output_file, stats)
+
+   # records the rules of an indicator type that were written, removing the file if there are none
+   def written(self, indicator_type, output_file, stats):
+      count = stats['indicators']
+      for name, value in stats.items():
+         metrics.add(name, value, indicator_type)
+
+      logging.info("exported {0} indicators of type {1} to {2}".format(count, indicator_type, output_file))
+      if count == 0:
+         logging.warning("no strings were exported for {0}, removing {1}".format(indicator_type, output_file))
+         try:
+            remove_output(output_file)
+         except Exception as e:
+            logging.error("unable to remove {0}: {1}".format(output_file, str(e)))
+
+   # writes the types that are still rendering as each one is done
+   def finish(self):
+      with self.lock:
+         rendering = dict([(future, indicator_type) for indicator_type, future in self.rendered.items()])
+         self.rendered = {}
+      for future in as_completed(rendering):
+         self.write_type(rendering[future], future)
+
+      if get_compiled_rules(self.config):
+         save_compiled_rules(self.rule_dir, get_compiled_rules(self.config))
+
+   def close(self):
+      if self.renderer is not None:
+         self.renderer.shutdown()
+
+# the indicators are written as (Indicator_Type, Indicator, ObjectID, ObjectIDs) with a table per type
+# and all of them together in the all_indicators table
+# with several tenants (one config each) every tenant gets its own tables of the indicators its sources allow
+class SplunkSink(object):
+   types = SPLUNK_TYPES
+   fields = ()
+   multi_tenant = True
+
+   # the first tenant is config, which is used for everything that is not specific to a tenant
+   def __init__(self, config, source, tenants=None):
+      self.config = config
+      self.source = source
+      self.tenants = tenants or [config]
+      # the source only filters out what no tenant exports, the rest is filtered for each tenant here
+      self.tenant_filters = None
+      if len(self.tenants) > 1:
+         if not hasattr(source, 'get_sources'):
+            raise ValueError("the indicators of this source can not be exported for several tenants at once")
+         self.tenant_filters = [SourceFilter.from_config(tenant_config) for tenant_config in self.tenants]
+
+      # every tenant gets the same keys, only the first config decides how they are written
+      self.header = get_lookup_header(config)
+      self.lookup_keys = get_lookup_keys(config)
+      # indicator type -> (the rows of each tenant for the type that is downloading, counts)
+      self.rows = {}
+
+   def get_filename(self, indtype, tenant_config=None):
+      if tenant_config is None:
+         tenant_config = self.config
+      out = indtype.replace(" ","")
+      out = out.replace("-","")
+      out = out.lower()
+      out = tenant_config['global']['splunk_lookup_table_dir'] + "/" + tenant_config['global']['splunk_lookup_table_prefex'] + out + get_lookup_suffix(tenant_config)
+      return out
+
+   # the types with a lookup table that is missing or was written with another header (lookup mode)
+   def stale_types(self):
+      header = io.BytesIO()
+      write_lookup_table(header, [], self.header)
+      header = header.getvalue()
+
+      stale_types = set()
+      for indicator_type in self.types:
+         for tenant_config in self.tenants:
+            filename = self.get_filename(indicator_type, tenant_config)
+            if not os.path.exists(filename):
+               stale_types.add(indicator_type)
+               continue
+
+            with read_lookup_file(filename) as f:
+               if f.readline() != header:
+                  stale_types.add(indicator_type)
+
+      return stale_types
+
+   # only the lookup rows are kept, each indicator is normalized as it arrives
+   def start_type(self, indicator_type):
+      logging.info("creating splunk export {0}".format(', '.join([self.get_filename(indicator_type, tenant_config) for tenant_config in self.tenants])))
+      tenant_rows = [LookupRows() for tenant_config in self.tenants]
+      # the number of indicators of each tenant and the number of variants
+      counts = [0] * len(self.tenants)
+      variant_count = [0]
+      self.rows[indicator_type] = (tenant_rows, counts, variant_count)
+
+      def add(row):
+         object_id = '{0}{1}'.format(self.source.lookup_id_prefix, row['id'])
+         keys = self.lookup_keys(row['type'], row['value'])
+         variant_count[0] += len(keys)
+         if self.tenant_filters is not None:
+            sources = self.source.get_sources(row)
+
+         for index, rows in enumerate(tenant_rows):
+            if self.tenant_filters is not None and not self.tenant_filters[index].accepts(sources):
+               continue
+
+            for key in keys:
+               rows.add(row['type'], key, object_id)
+            counts[index] += 1
+
+      return add
+
+   def finish_type(self, indicator_type):
+      tenant_rows, counts, variant_count = self.rows.pop(indicator_type)
+      metrics.add('variants', variant_count[0], indicator_type)
+      for tenant_config, rows, count in zip(self.tenants, tenant_rows, counts):
+         filename = self.get_filename(indicator_type, tenant_config)
+         # sorting and formatting the rows, which are formatted straight into the file
+         start = time.perf_counter()
+         if get_sorted_output(self.config):
+            rows.sort()
+
+         with write_lookup_file(filename) as f:
+            write_lookup_table(f, rows, self.header)
+            metrics.add('render_seconds', time.perf_counter() - start, indicator_type)
+
+         metrics.add('lookup_rows', len(rows), indicator_type)
+
+         logging.info("exported {0} indicators as {1} rows to {2}".format(count, len(rows), filename))
+
+   # the all indicators table is every type's table appended together, including the tables
+   # of the types that did not change since they were written by an earlier export
+   # the rows are copied as they were written so they are only formatted once
+   def finish(self):
+      for tenant_config in self.tenants:
+         all_filename = self.get_filename('all_indicators', tenant_config)
+         with write_lookup_file(all_filename) as all_f:
+            write_lookup_table(all_f, [], self.header)
+            for indicator_type in self.types:
+               filename = self.get_filename(indicator_type, tenant_config)
+               if not os.path.exists(filename):
+                  continue
+
+               with read_lookup_file(filename) as f:
+                  f.readline() # skip the header
+                  shutil.copyfileobj(f, all_f, WRITE_BUFFER_SIZE)
+
+         sync_kvstore(tenant_config, all_filename)
+
+   def close(self):
+      pass
+
+# the ssdeep hashes of samples that ACE loads, only CRITS has the samples
+class SsdeepSink(object):
+   types = ['Hash - SSDEEP']
+   fields = ('relationships', 'bucket_list', 'campaign')
+
+   def __init__(self, config, source):
+      if not isinstance(source, CritsSource):
+         raise ValueError("the ssdeep export needs the samples in CRITS")
+
+      self.config = config
+      self.db = source.db
+      if not config.get('global', 'ssdeep_dir', fallback=''):
+         raise ValueError("[global] ssdeep_dir is needed to export the ssdeep hashes")
+      self.output_file = config.get('global','ssdeep_dir') + "/ssdeep.json"
+      self.indicators = []
+
+   def stale_types(self):
+      return set() if os.path.exists(self.output_file) else set(self.types)
+
+   # the mimetypes of the related samples are looked up for all of the indicators at once
+   def start_type(self, indicator_type):
+      self.indicators = []
+      return self.indicators.append
+
+   def finish_type(self, indicator_type):
+      indicators = self.indicators
+      self.indicators = []
+      if get_sorted_output(self.config):
+         indicators = sorted(indicators, key=lambda row: (row['value'], row['id']))
+
+      # look up the mimetypes of all the related samples at once instead of one query per relationship
+      sample_ids = set()
+      for row in indicators:
+         for rel in row['relationships']:
+            sample_ids.add(ObjectId(rel['value']))
+
+      mimetypes = {}
+      for sample in self.db.sample.find({'_id': {'$in': list(sample_ids)}}, {'mimetype': True}):
+         mimetypes[sample['_id']] = sample.get('mimetype')
+
+      # each indicator is written once if any of its related samples has a mimetype we keep
+      with atomic_write(self.output_file) as outfile:
+         outfile.write('{"objects": [')
+         count = 0
+         for row in indicators:
+            for rel in row['relationships']:
+               sample_id = ObjectId(rel['value'])
+               if sample_id in mimetypes and mimetypes[sample_id] not in SSDEEP_NOT_MIMETYPES:
+                  break
+            else:
+               continue
+
+            if count:
+               outfile.write(', ')
+            outfile.write(dumps( { 'id' : row['id'], 'ssdeep' : row['value'], 'tags' : row['bucket_list'], 'campaigns' : row['campaign'] } ))
+            count += 1
+
+         outfile.write(']}')
+
+      logging.info("exported {0} of {1} ssdeep hashes to {2}".format(count, len(indicators), self.output_file))
+
+   def finish(self):
+      pass
+
+   def close(self):
+      pass
+
+# creates the indexes the CRITS queries use
+def ensure_indexes(config):
+   source = CritsSource(config)
+   try:
+      ensure_crits_indexes(source.db)
+   finally:
+      source.close()
+
+SOURCES = { 'crits': CritsSource, 'sip': SipSource }
+SINKS = { 'yara': YaraSink, 'splunk': SplunkSink, 'ssdeep': SsdeepSink }
+
+# the sinks used when none are given
+DEFAULT_SINKS = { 'crits': ['yara', 'splunk', 'ssdeep'], 'sip': ['yara', 'splunk'] }
+
+# the filter of everything any of the tenants exports
+def get_source_filter(config, tenants=None):
+   return SourceFilter.union([SourceFilter.from_config(tenant_config) for tenant_config in tenants or [config]])
+
+# opens the named source for the tenants (one config each, the first one is config)
+# the options (the SIP indicator_store and full) are passed to the source
+def open_source(config, source_name, tenants=None, **options):
+   return SOURCES[source_name](config, get_source_filter(config, tenants), **options)
+
+# exports the indicators of the named source to the named sinks
+# a source that is passed in is left open so it can be used again, it has to be opened for the same tenants
+# tenants are the configs of every tenant the splunk lookup tables are exported for, the first one is config
+def run_export(config, source_name, sink_names, source=None, tenants=None):
+   tenants = tenants or [config]
+   owns_source = source is None
+   if owns_source:
+      source = open_source(config, source_name, tenants)
+   sinks = []
+   try:
+      for sink_name in sink_names:
+         sink_class = SINKS[sink_name]
+         if getattr(sink_class, 'multi_tenant', False):
+            sinks.append(sink_class(config, source, tenants))
+         elif len(tenants) > 1:
+            raise ValueError("the {0} export can only export a single tenant".format(sink_name))
+         else:
+            sinks.append(sink_class(config, source))
+
+      # every type any of the sinks exports and every field any of them needs for it
+      types = []
+      fields = {}
+      for sink in sinks:
+         for indicator_type in sink.types:
+            if indicator_type not in fields:
+               types.append(indicator_type)
+               fields[indicator_type] = set()
+            fields[indicator_type].update(sink.fields)
+
+      # each indicator is passed to every sink of its type as it arrives
+      def export_type(indicator_type, indicators):
+         type_sinks = [sink for sink in sinks if indicator_type in sink.types]
+         adds = [sink.start_type(indicator_type) for sink in type_sinks]
+         count = 0
+         for row in indicators:
+            count += 1
+            for add in adds:
+               add(row)
+
+         metrics.add('rows', count, indicator_type)
+         for sink in type_sinks:
+            sink.finish_type(indicator_type)
+
+      stale_types = set()
+      for sink in sinks:
+         stale_types.update(sink.stale_types())
+
+      logging.info("exporting {0} indicator types from {1} to {2}".format(len(types), source_name, ', '.join(sink_names)))
+      source.fetch(types, fields, export_type, stale_types)
+
+      for sink in sinks:
+         sink.finish()
+
+      source.commit()
+
+   except:
+      source.rollback()
+      raise
+
+   finally:
+      for sink in sinks:
+         sink.close()
+      if owns_source:
+         source.close()
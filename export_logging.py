@@ -0,0 +1,67 @@
+# vim: ts=3:sw=3:et
+
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import os
+import os.path
+import queue
+
+# the listener that writes the queued log records, None when logging is not queued
+_listener = None
+
+# the handlers from etc/logging.ini that the listener writes the records to
+_handlers = []
+
+# the logging configuration that was loaded, the render worker processes load it as well
+_config_path = None
+
+def get_queued_logging(config):
+   return config.getboolean('global', 'queued_logging', fallback=False)
+
+# loads the logging configuration, when it is queued the records are put on a queue by the thread that
+# logs them and formatted, colorized and written by the handlers of the config in a background thread
+def init_logging(config, logging_config_path='etc/logging.ini'):
+   global _listener, _handlers, _config_path
+
+   if not os.path.isdir('logs'):
+      os.mkdir('logs')
+   logging.config.fileConfig(logging_config_path)
+   _config_path = os.path.abspath(logging_config_path)
+
+   if not get_queued_logging(config):
+      return
+
+   root = logging.getLogger()
+   _handlers = list(root.handlers)
+   for handler in _handlers:
+      root.removeHandler(handler)
+
+   records = queue.SimpleQueue()
+   root.addHandler(logging.handlers.QueueHandler(records))
+   _listener = logging.handlers.QueueListener(records, *_handlers, respect_handler_level=True)
+   _listener.start()
+
+   # logging flushes and closes the handlers when python exits, after whatever is still queued is written
+   atexit.register(_listener.stop)
+
+# the path of the logging configuration that was loaded, None if logging was set up some other way
+def get_logging_config_path():
+   return _config_path
+
+# the worker processes of the daemon are forked without the listener thread so they write to the handlers themselves
+# the render worker processes start without any logging and load the configuration at logging_config_path
+def init_worker_logging(logging_config_path=None):
+   if logging_config_path is not None:
+      logging.config.fileConfig(logging_config_path)
+      return
+
+   if _listener is None:
+      return
+
+   root = logging.getLogger()
+   for handler in list(root.handlers):
+      root.removeHandler(handler)
+   for handler in _handlers:
+      root.addHandler(handler)
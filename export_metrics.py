@@ -0,0 +1,155 @@
+# vim: ts=3:sw=3:et
+
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Counters and timings of a single export run, for the whole run and for each
+# indicator type, plus the size of every output file written and whether it
+# changed.  Anything can add to the metrics, including the fetch threads.
+#
+# [metrics]
+# ; file a JSON line with the metrics of every run is appended to
+# json_file =
+# ; prometheus textfile collector file the metrics of the last run are written to
+# prometheus_file =
+#
+# fetch_seconds is only the time spent waiting for the indicators (see iter_timed), not what
+# the sinks do with them, render_seconds is the sinks turning them into rules or lookup rows
+# and write_seconds is a file being written (which includes rendering into it).
+#
+# The names used so far:
+#   run:  bytes_received, kvstore_saved, kvstore_deleted, kvstore_bytes_sent, fetch_seconds (delta syncs)
+#   type: fetch_seconds, rows, variants, strings, lookup_rows, render_seconds, indicators
+#   file: bytes, changed, write_seconds
+class RunMetrics(object):
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.reset()
+
+   # starts over for the next run of an exporter that keeps running
+   def reset(self):
+      with self.lock:
+         self.started = time.time()
+         self.run = {}
+         self.types = {}
+         self.files = {}
+
+   # adds value to a counter of the run or of an indicator type
+   def add(self, name, value, indicator_type=None):
+      with self.lock:
+         counters = self.run if indicator_type is None else self.types.setdefault(indicator_type, {})
+         counters[name] = counters.get(name, 0) + value
+
+   # adds the seconds spent in the with block to a counter
+   @contextmanager
+   def timer(self, name, indicator_type=None):
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         self.add(name, time.perf_counter() - start, indicator_type)
+
+   # yields the items of iterator, adding only the seconds spent getting each item to a counter
+   # so whatever the caller does with the items in between is not counted
+   def iter_timed(self, iterator, name, indicator_type=None):
+      iterator = iter(iterator)
+      seconds = 0
+      try:
+         while True:
+            start = time.perf_counter()
+            try:
+               item = next(iterator)
+            except StopIteration:
+               return
+            finally:
+               seconds += time.perf_counter() - start
+
+            yield item
+
+      finally:
+         self.add(name, seconds, indicator_type)
+
+   def add_file(self, path, size, changed, seconds):
+      with self.lock:
+         self.files[path] = { 'bytes': size, 'changed': changed, 'write_seconds': seconds }
+
+   # forgets a file that was written and then removed again
+   def remove_file(self, path):
+      with self.lock:
+         self.files.pop(path, None)
+
+   # returns everything as a dict for the named run
+   def get_record(self, name):
+      with self.lock:
+         return {
+            'run': name,
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'metrics': dict(self.run),
+            'types': dict([(indicator_type, dict(counters)) for indicator_type, counters in self.types.items()]),
+            'files': dict([(path, dict(counters)) for path, counters in self.files.items()]),
+         }
+
+# the metrics of this run
+metrics = RunMetrics()
+
+def escape_label(value):
+   return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_sample(name, labels, value):
+   return '{0}{{{1}}} {2}\n'.format(name, ','.join(['{0}="{1}"'.format(key, escape_label(label)) for key, label in labels]), float(value))
+
+# returns the record in the prometheus text format
+def format_prometheus(record):
+   run = [('run', record['run'])]
+   lines = []
+   lines.append('# TYPE detect_export_last_run_timestamp_seconds gauge\n')
+   lines.append(format_sample('detect_export_last_run_timestamp_seconds', run, record['started']))
+   lines.append('# TYPE detect_export_run_seconds gauge\n')
+   lines.append(format_sample('detect_export_run_seconds', run, record['seconds']))
+
+   for name, value in sorted(record['metrics'].items()):
+      lines.append('# TYPE detect_export_{0} gauge\n'.format(name))
+      lines.append(format_sample('detect_export_{0}'.format(name), run, value))
+
+   names = sorted(set([name for counters in record['types'].values() for name in counters]))
+   for name in names:
+      lines.append('# TYPE detect_export_type_{0} gauge\n'.format(name))
+      for indicator_type, counters in sorted(record['types'].items()):
+         if name in counters:
+            lines.append(format_sample('detect_export_type_{0}'.format(name), run + [('type', indicator_type)], counters[name]))
+
+   for name in ('bytes', 'changed', 'write_seconds'):
+      lines.append('# TYPE detect_export_file_{0} gauge\n'.format(name))
+      for path, counters in sorted(record['files'].items()):
+         lines.append(format_sample('detect_export_file_{0}'.format(name), run + [('path', path)], counters[name]))
+
+   return ''.join(lines)
+
+# writes the metrics of the named run to the files in the [metrics] section of the config
+def write_metrics(config, name):
+   record = metrics.get_record(name)
+
+   json_path = config.get('metrics', 'json_file', fallback='')
+   if json_path:
+      with open(json_path, 'a') as fp:
+         fp.write(json.dumps(record, sort_keys=True))
+         fp.write('\n')
+
+   # the textfile collector reads every .prom file in its directory, so the file is
+   # written under a different name first and then renamed
+   prometheus_path = config.get('metrics', 'prometheus_file', fallback='')
+   if prometheus_path:
+      temp_path = '{0}.{1}.tmp'.format(prometheus_path, os.getpid())
+      with open(temp_path, 'w') as fp:
+         fp.write(format_prometheus(record))
+      os.replace(temp_path, prometheus_path)
+
+   logging.info("run {0} took {1:.2f} seconds, wrote {2} files ({3} changed)".format(
+      name, record['seconds'], len(record['files']), len([path for path, counters in record['files'].items() if counters['changed']])))
@@ -0,0 +1,118 @@
+# vim: ts=3:sw=3:et
+
+import hashlib
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from export_metrics import metrics
+
+# mkstemp creates files only readable by us, the output files get the normal permissions
+_umask = os.umask(0)
+os.umask(_umask)
+
+# output files are written through a buffer this large
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# the output files that were created, modified or removed by this run
+changed_files = []
+
+# the output files that did not exist before this run
+created_files = set()
+
+def get_digest(path):
+   digest = hashlib.sha256()
+   with open(path, 'rb') as fp:
+      for block in iter(lambda: fp.read(1024 * 1024), b''):
+         digest.update(block)
+   return digest.digest()
+
+def is_same_content(path, other_path):
+   if not os.path.exists(other_path):
+      return False
+   if os.path.getsize(path) != os.path.getsize(other_path):
+      return False
+   return get_digest(path) == get_digest(other_path)
+
+def fsync_path(path):
+   fd = os.open(path, os.O_RDONLY)
+   try:
+      os.fsync(fd)
+   finally:
+      os.close(fd)
+
+# sort the rules and lookup table rows so the output only changes when the indicators do
+# instead of following whatever order the indicators were downloaded in
+def get_sorted_output(config):
+   return config.getboolean('global', 'sorted_output', fallback=True)
+
+# opens a temporary file next to path for writing that replaces path only once
+# everything has been written, so readers never see a partially written file
+# and a failed export leaves the previous file in place
+# if the new content is the same as what is already in path then path is left alone
+# the new content is on disk (fsync) before it replaces path
+@contextmanager
+def atomic_write(path, mode='w', **kwargs):
+   kwargs.setdefault('buffering', WRITE_BUFFER_SIZE)
+   start = time.perf_counter()
+   directory = os.path.dirname(os.path.abspath(path))
+   fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.{0}.'.format(os.path.basename(path)), suffix='.tmp')
+   try:
+      with open(fd, mode, **kwargs) as fp:
+         yield fp
+
+      size = os.path.getsize(temp_path)
+      if is_same_content(temp_path, path):
+         logging.debug("{0} has not changed".format(path))
+         os.remove(temp_path)
+         metrics.add_file(path, size, False, time.perf_counter() - start)
+         return
+
+      if not os.path.exists(path):
+         created_files.add(path)
+
+      os.chmod(temp_path, 0o666 & ~_umask)
+      fsync_path(temp_path)
+      os.replace(temp_path, path)
+      fsync_path(directory)
+      changed_files.append(path)
+      metrics.add_file(path, size, True, time.perf_counter() - start)
+
+   except:
+      try:
+         os.remove(temp_path)
+      except OSError:
+         pass
+
+      raise
+
+# removes an output file that should no longer exist
+def remove_output(path):
+   if not os.path.exists(path):
+      return
+
+   os.remove(path)
+
+   # removing a file this run created leaves things as they were
+   if path in created_files:
+      created_files.discard(path)
+      changed_files.remove(path)
+      metrics.remove_file(path)
+      return
+
+   changed_files.append(path)
+
+# starts over for the next run of an exporter that keeps running
+def reset_changed_files():
+   del changed_files[:]
+   created_files.clear()
+
+# writes the list of changed output files, one per line, so the caller can tell if anything changed
+def write_changed_files(path):
+   with open(path, 'w') as fp:
+      for changed_file in changed_files:
+         fp.write('{0}\n'.format(changed_file))
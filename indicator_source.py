@@ -0,0 +1,88 @@
+# vim: ts=3:sw=3:et
+
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# default number of indicator types downloaded at the same time
+DEFAULT_FETCH_WORKERS = 8
+
+# default number of indicators requested from SIP (or Mongo) at a time
+DEFAULT_PAGE_SIZE = 1000
+
+# the only fields of the CRITS indicator documents the exporters use
+CRITS_PROJECTION = { '_id': True, 'type': True, 'value': True }
+
+# the indexes of the CRITS indicators collection the exporter queries use as (name, keys)
+CRITS_INDEXES = [ ('status_type_source_name', [ ('status', 1), ('type', 1), ('source.name', 1) ]) ]
+
+def get_fetch_workers(config):
+   return config.getint('sip', 'fetch_workers', fallback=DEFAULT_FETCH_WORKERS)
+
+def get_page_size(config):
+   return config.getint('global', 'page_size', fallback=DEFAULT_PAGE_SIZE)
+
+# calls fetch(indicator_type) for all of the indicator types at the same time
+# (at most max_workers at once) and yields (indicator_type, result) as each one completes
+# so the caller can process the results of one type while the others are still downloading
+def fetch_types(fetch, indicator_types, max_workers=DEFAULT_FETCH_WORKERS):
+   executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch')
+   try:
+      futures = {}
+      for indicator_type in indicator_types:
+         futures[executor.submit(fetch, indicator_type)] = indicator_type
+
+      for future in as_completed(futures):
+         indicator_type = futures[future]
+         logging.debug("finished downloading indicator type {0}".format(indicator_type))
+         yield indicator_type, future.result()
+
+   finally:
+      # don't bother downloading anything else if the caller failed or stopped early
+      executor.shutdown(wait=True, cancel_futures=True)
+
+# yields the indicators returned by a SIP query one page at a time
+# so only page_size indicators are ever held in memory
+def iter_sip_indicators(sip_client, endpoint, page_size=DEFAULT_PAGE_SIZE):
+   separator = '&' if '?' in endpoint else '?'
+   result = sip_client.get('{}{}per_page={}'.format(endpoint, separator, page_size))
+   while True:
+      # bulk queries are not paginated
+      if not isinstance(result, dict) or 'items' not in result:
+         yield from result
+         return
+
+      yield from result['items']
+
+      next_page = result.get('_links', {}).get('next')
+      if not next_page:
+         return
+
+      result = sip_client.get(next_page)
+
+# returns a cursor over the CRITS indicators that match the query
+# that only transfers the fields the exporters use, batch_size documents at a time
+def iter_crits_indicators(db, query, projection=CRITS_PROJECTION, batch_size=DEFAULT_PAGE_SIZE):
+   return db.indicators.find(query, projection, batch_size=batch_size)
+
+# creates the CRITS_INDEXES that do not exist yet
+def ensure_crits_indexes(db):
+   for name, keys in CRITS_INDEXES:
+      logging.info("ensuring index {0} on {1}".format(name, ', '.join([key for key, direction in keys])))
+      db.indicators.create_index(keys, name=name)
+
+# returns a summary of how mongo runs the query, this runs the query
+def explain_crits_query(db, query, projection=CRITS_PROJECTION):
+   explain = db.indicators.find(query, projection).explain()
+   stats = explain.get('executionStats', {})
+
+   # the index used is on the innermost stage of the plan
+   index_name = None
+   stage = explain.get('queryPlanner', {}).get('winningPlan')
+   while stage:
+      index_name = stage.get('indexName', index_name)
+      stage = stage.get('inputStage')
+
+   return "returned {0} documents after examining {1} keys and {2} documents in {3}ms using {4}".format(
+      stats.get('nReturned'), stats.get('totalKeysExamined'), stats.get('totalDocsExamined'),
+      stats.get('executionTimeMillis'), 'index {0}'.format(index_name) if index_name else 'a collection scan')
@@ -0,0 +1,174 @@
+# vim: ts=3:sw=3:et
+
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+
+from datetime import datetime, timedelta
+from itertools import islice
+
+# format used for the high water mark and by the SIP modified_after query
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# number of rows read or written at a time
+BATCH_SIZE = 1000
+
+# minutes before the last sync that are read again to cover clock skew with the SIP server
+def get_sync_overlap(config):
+   return timedelta(minutes=config.getint('global', 'sync_overlap_minutes', fallback=5))
+
+# the sources of an indicator as they are stored, None if SIP did not return them
+def get_stored_sources(row):
+   if 'references' not in row:
+      return None
+   return json.dumps(sorted(set([ref['source'] for ref in row['references']])))
+
+def batched(iterable, size):
+   iterator = iter(iterable)
+   while True:
+      batch = list(islice(iterator, size))
+      if not batch:
+         return
+      yield batch
+
+# A local copy of the exportable (Analyzed, source filtered) SIP indicators keyed
+# by SIP indicator id, with their sources so they can be filtered for each tenant.  Each run only pulls the indicators modified since the
+# last successful sync (the high water mark) and applies them here, so we know
+# exactly which indicator types changed and need their output regenerated.
+#
+# Everything done between opening the store and commit() is a single
+# transaction, so if the export fails part way through the store and the high
+# water mark are left as they were and the next run picks up the same changes.
+class IndicatorStore(object):
+   def __init__(self, path):
+      self.path = path
+      directory = os.path.dirname(path)
+      if directory and not os.path.isdir(directory):
+         os.makedirs(directory)
+
+      # shared with the fetch threads, all access goes through the lock
+      self.lock = threading.RLock()
+      self.db = sqlite3.connect(path, check_same_thread=False)
+      self.db.execute("""CREATE TABLE IF NOT EXISTS indicators (
+                            id INTEGER PRIMARY KEY,
+                            type TEXT NOT NULL,
+                            value TEXT NOT NULL,
+                            sources TEXT)""")
+      self.db.execute("CREATE INDEX IF NOT EXISTS indicators_type ON indicators (type)")
+      self.db.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+                            key TEXT PRIMARY KEY,
+                            value TEXT)""")
+
+      # stores created before the sources were kept get them with the next full sync
+      columns = [column[1] for column in self.db.execute("PRAGMA table_info(indicators)")]
+      if 'sources' not in columns:
+         logging.info("adding sources to {0}, the next sync is a full sync".format(path))
+         self.db.execute("ALTER TABLE indicators ADD COLUMN sources TEXT")
+         self.db.execute("DELETE FROM sync_state WHERE key = 'fingerprint'")
+
+      self.db.commit()
+
+   def get_state(self, key):
+      with self.lock:
+         row = self.db.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+      return row[0] if row else None
+
+   def set_state(self, key, value):
+      with self.lock:
+         self.db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+   def high_water_mark(self):
+      value = self.get_state('high_water_mark')
+      if value is None:
+         return None
+      return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+   def set_high_water_mark(self, timestamp):
+      self.set_state('high_water_mark', timestamp.strftime(TIMESTAMP_FORMAT))
+
+   # replaces every stored indicator of the given type with rows (full sync)
+   # rows can be a generator that is still downloading, the lock is only held
+   # while a batch is inserted so other threads can load their types at the same time
+   def replace_type(self, indicator_type, rows, batch_size=BATCH_SIZE):
+      with self.lock:
+         self.db.execute("DELETE FROM indicators WHERE type = ?", (indicator_type,))
+
+      for batch in batched(rows, batch_size):
+         with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO indicators (id, type, value, sources) VALUES (?, ?, ?, ?)",
+                                [(int(row['id']), row['type'], row['value'], get_stored_sources(row)) for row in batch])
+
+   # applies a delta pulled from SIP
+   # exportable are the modified indicators that should be exported
+   # removed_ids are the ids of modified indicators that should no longer be exported
+   # (status changed away from Analyzed, source now excluded, etc...)
+   # exportable is consumed before removed_ids so removed_ids can be a generator that depends on it
+   # returns the set of indicator types whose contents changed
+   def apply_delta(self, exportable, removed_ids):
+      changed_types = set()
+      exportable_count = 0
+      removed_count = 0
+      with self.lock:
+         for row in exportable:
+            exportable_count += 1
+            sources = get_stored_sources(row)
+            current = self.db.execute("SELECT type, value, sources FROM indicators WHERE id = ?", (int(row['id']),)).fetchone()
+            if current == (row['type'], row['value'], sources):
+               continue
+
+            if current is not None:
+               changed_types.add(current[0])
+
+            self.db.execute("INSERT OR REPLACE INTO indicators (id, type, value, sources) VALUES (?, ?, ?, ?)",
+                            (int(row['id']), row['type'], row['value'], sources))
+            changed_types.add(row['type'])
+
+         for indicator_id in removed_ids:
+            current = self.db.execute("SELECT type FROM indicators WHERE id = ?", (int(indicator_id),)).fetchone()
+            if current is None:
+               continue
+
+            self.db.execute("DELETE FROM indicators WHERE id = ?", (int(indicator_id),))
+            changed_types.add(current[0])
+            removed_count += 1
+
+      logging.debug("applied delta of {0} exportable and {1} removed indicators, changed types {2}".format(
+                    exportable_count, removed_count, sorted(changed_types)))
+      return changed_types
+
+   def has_type(self, indicator_type):
+      with self.lock:
+         return self.db.execute("SELECT 1 FROM indicators WHERE type = ? LIMIT 1", (indicator_type,)).fetchone() is not None
+
+   # yields the stored indicators of the given type in the same format SIP returns them
+   def iter_type(self, indicator_type, batch_size=BATCH_SIZE):
+      last_id = -1
+      while True:
+         with self.lock:
+            rows = self.db.execute("SELECT id, type, value, sources FROM indicators WHERE type = ? AND id > ? ORDER BY id LIMIT ?",
+                                   (indicator_type, last_id, batch_size)).fetchall()
+         if not rows:
+            return
+
+         for indicator_id, row_type, value, sources in rows:
+            item = { 'id': indicator_id, 'type': row_type, 'value': value }
+            if sources is not None:
+               item['references'] = [{ 'source': source } for source in json.loads(sources)]
+            yield item
+
+         last_id = rows[-1][0]
+
+   def commit(self):
+      with self.lock:
+         self.db.commit()
+
+   def rollback(self):
+      with self.lock:
+         self.db.rollback()
+
+   def close(self):
+      with self.lock:
+         self.db.close()
@@ -0,0 +1,169 @@
+# vim: ts=3:sw=3:et
+
+import re
+
+# Expands indicator values into the variants that actually get matched in the
+# yara rules and splunk lookup tables.  The patterns are compiled once when this
+# module is imported and looked up by indicator type, so every value is only
+# scanned once no matter how many patterns there are.
+
+# environment variables in file paths and what they usually expand to
+SPECIAL_PATHS = {"%temp%":["\\windows\\temp","\\temp","\\appdata\\local\\temp","\\local settings\\temp","\\locals~1\\temp" ],
+                 "%appdata%":["\\application data","\\appdata\\roaming"],
+                 "%programdata%":["\\programdata","\\documents and settings\\all users"],
+                 "%programfiles%":["\\program files","\\program files (x86)"],
+                 "%systemdrive%":[""],
+                 "%system%":["\\windows\\system32","\\windows\\system"]
+                }
+
+# registry hives that are removed from the front of registry keys
+SPECIAL_REG = ['hkcu\\','hklm\\','hkc\\','hku\\','hkcr\\']
+
+# url schemes that are removed from the front of urls
+SPECIAL_URL = ['http:','https:']
+
+SPECIAL_PATHS_RE = re.compile('|'.join([re.escape(path) for path in SPECIAL_PATHS]))
+SPECIAL_REG_RE = re.compile('|'.join([re.escape(reg) for reg in SPECIAL_REG]))
+SPECIAL_URL_RE = re.compile('|'.join([re.escape(url) for url in SPECIAL_URL]))
+BACKSLASHES_RE = re.compile(r'\\+')
+
+# how a canonical lookup value is matched and the splunk wildcard pattern that matches it that way
+MATCH_PATTERNS = {
+   'exact': '{0}',
+   'prefix': '{0}*',
+   'suffix': '*{0}',
+   'substring': '*{0}*',
+   # anchored at the root of any drive (c:, d:, ...), the value starts with a \
+   'drive': '*:{0}',
+}
+
+# yields every expansion of the environment variables in a lower case file path
+# each variant expands a single environment variable, in the order of SPECIAL_PATHS
+def expand_path(value):
+   found = set(SPECIAL_PATHS_RE.findall(value))
+   if not found:
+      return
+
+   for path in SPECIAL_PATHS:
+      if path in found:
+         for p_item in SPECIAL_PATHS[path]:
+            yield value.replace(path, p_item)
+
+def strip_registry(value):
+   return SPECIAL_REG_RE.sub('', value.lower())
+
+def strip_url(value):
+   match = SPECIAL_URL_RE.match(value)
+   if match is None:
+      return value
+   return value.lower()[match.end():]
+
+# lower case with every separator (or run of separators) replaced by a single \
+# the detect_normalize_path splunk macro does the same to the field it is matched against
+def canonical_path(value):
+   return BACKSLASHES_RE.sub(r'\\', value.lower().replace('/', '\\'))
+
+# each yara transform returns a list of (string id suffix, value)
+
+def _yara_value(value):
+   return [('', value)]
+
+def _yara_path(value):
+   variants = [('_{}'.format(index), variant) for index, variant in enumerate(expand_path(value.lower()))]
+   return variants or [('', value)]
+
+def _yara_registry(value):
+   return [('', strip_registry(value))]
+
+def _yara_url(value):
+   return [('', strip_url(value))]
+
+YARA_TRANSFORMS = {
+   'Windows - FilePath': _yara_path,
+   'Windows - Registry': _yara_registry,
+}
+
+YARA_TRANSFORMS_STRIP_URL = dict(YARA_TRANSFORMS)
+YARA_TRANSFORMS_STRIP_URL['URI - URL'] = _yara_url
+
+# each splunk transform returns a list of values
+
+def _splunk_value(value):
+   return [value]
+
+def _splunk_path(value):
+   lowered = value.lower()
+   variants = list(expand_path(lowered))
+   #replace \ with /
+   variants.append(lowered.replace("\\","/"))
+   #replace \ with \\
+   variants.append(lowered.replace("\\","\\\\"))
+   #write it like it is in crits as well (cover all our basis splunk logs can be shit formatted)
+   variants.append(value)
+   return variants
+
+def _splunk_registry(value):
+   return [strip_registry(value)]
+
+SPLUNK_TRANSFORMS = {
+   'Windows - FilePath': _splunk_path,
+   'Windows - Registry': _splunk_registry,
+}
+
+# each splunk match transform returns a list of (canonical value, match type)
+
+def _match_value(value):
+   return [(value, 'exact')]
+
+# returns every expansion of all of the environment variables in a lower case file path
+def expand_all_paths(value):
+   match = SPECIAL_PATHS_RE.search(value)
+   if match is None:
+      return [value]
+
+   path = match.group(0)
+   return [expansion for p_item in SPECIAL_PATHS[path] for expansion in expand_all_paths(value.replace(path, p_item))]
+
+# the environment variables stand for the start of the path so the expansions are matched as suffixes
+# an expansion that ends with another expansion is already matched by it
+# %systemdrive% is the root of a drive, not any directory, so those paths are anchored to a drive instead
+def _match_path(value):
+   path = canonical_path(value)
+   if SPECIAL_PATHS_RE.search(path) is None:
+      return [(path, 'exact')]
+
+   expansions = set([canonical_path(expansion) for expansion in expand_all_paths(path)])
+   if path.startswith('%systemdrive%'):
+      return [(expansion, 'drive') for expansion in sorted(expansions)]
+
+   expansions = [expansion for expansion in expansions if not any([other != expansion and expansion.endswith(other) for other in expansions])]
+   return [(expansion, 'suffix') for expansion in sorted(expansions)]
+
+# registry keys are logged with and without all sorts of hives in front of them
+def _match_registry(value):
+   return [('\\' + strip_registry(value).lstrip('\\'), 'suffix')]
+
+# urls are logged with and without the scheme and query string
+def _match_url(value):
+   return [(strip_url(value).lstrip('/'), 'substring')]
+
+SPLUNK_MATCH_TRANSFORMS = {
+   'Windows - FilePath': _match_path,
+   'Windows - Registry': _match_registry,
+   'URI - URL': _match_url,
+}
+
+# returns the variants as lookup keys of a single column
+def splunk_variant_keys(indicator_type, value):
+   return [(variant,) for variant in SPLUNK_TRANSFORMS.get(indicator_type, _splunk_value)(value)]
+
+# returns the lookup keys (canonical value, match type, match pattern) of the value
+def splunk_match_keys(indicator_type, value):
+   return [(match_value, match_type, MATCH_PATTERNS[match_type].format(match_value))
+      for match_value, match_type in SPLUNK_MATCH_TRANSFORMS.get(indicator_type, _match_value)(value)]
+
+# yields (indicator, [(string id suffix, value), ...]) for every indicator
+def iter_yara_variants(indicators, strip_url_scheme=False):
+   transforms = YARA_TRANSFORMS_STRIP_URL if strip_url_scheme else YARA_TRANSFORMS
+   for indicator in indicators:
+      yield indicator, transforms.get(indicator['type'], _yara_value)(indicator['value'])
@@ -0,0 +1,42 @@
+# vim: ts=3:sw=3:et
+
+import json
+
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pysip import Client, RequestError
+
+from export_metrics import metrics
+from indicator_source import DEFAULT_FETCH_WORKERS, get_fetch_workers
+
+# pysip opens a new connection for every request, this keeps a pool of
+# connections open to SIP that all of the fetch threads share
+class PooledClient(Client):
+   def __init__(self, sip_host, apikey, verify=True, pool_size=DEFAULT_FETCH_WORKERS):
+      Client.__init__(self, sip_host, apikey, verify=verify)
+      self._session = requests.Session()
+      self._session.headers['Authorization'] = 'Apikey {}'.format(self._apikey)
+      self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+   def get(self, endpoint):
+      # Clean up the given endpoint.
+      if endpoint.startswith('/'):
+         endpoint = endpoint[1:]
+      endpoint = endpoint.replace('api/', '')
+
+      request = self._session.get(urljoin(self._api_url, endpoint), verify=self._verify)
+      if not str(request.status_code).startswith('2'):
+         raise RequestError(request.text)
+
+      metrics.add('bytes_received', len(request.content))
+      return json.loads(request.text)
+
+   def close(self):
+      self._session.close()
+
+def get_sip_client(config):
+   return PooledClient(config['sip']['end_point'], config['sip']['api_key'], verify=config['sip']['cert'],
+                       pool_size=get_fetch_workers(config))
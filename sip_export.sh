@@ -10,15 +10,22 @@ fi
 ##### Splunk Lookup Table Exports ##################################################
 ####################################################################################
 cd "${DETECT_EXPORTS}" || exit 1
-#Ashland
-python3 sip_export_splunk.py -c etc/ashland_detect_export.ini
-(cd "${DETECT_EXPORTS}/ashland_splunk_lookup_tables" && git add *.csv > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
-#Valvoline
-python3 sip_export_splunk.py -c etc/valvoline_detect_export.ini
-(cd "${DETECT_EXPORTS}/valvoline_splunk_lookup_tables" && git add *.csv > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
-#Integral
-python3 sip_export_splunk.py -c etc/integral_detect_export.ini
-(cd "${DETECT_EXPORTS}/integral_splunk_lookup_tables" && git add *.csv > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
+
+# the exporter lists the output files it changed here, nothing gets committed if nothing changed
+CHANGED_FILES=$(mktemp) || exit 1
+trap 'rm -f "${CHANGED_FILES}"' EXIT
+
+# every tenant's lookup tables are exported from a single download of the indicators
+python3 sip_export_splunk.py \
+    -c etc/ashland_detect_export.ini \
+    -c etc/valvoline_detect_export.ini \
+    -c etc/integral_detect_export.ini \
+    --changed-files "${CHANGED_FILES}"
+
+for tenant in ashland valvoline integral
+do
+    grep -q "${tenant}_splunk_lookup_tables/" "${CHANGED_FILES}" && (cd "${DETECT_EXPORTS}/${tenant}_splunk_lookup_tables" && git add -A . > /dev/null && git commit -m "automated commit $(date '+%Y%m%d%H%M%S')" > /dev/null && git push origin production > /dev/null )
+done
 
 cd "${DETECT_EXPORTS}"
 
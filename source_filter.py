@@ -0,0 +1,73 @@
+# vim: ts=3:sw=3:et
+
+# Decides which indicators get exported based on their intel sources.
+#
+# [sources]
+# ; comma separated list of sources to NOT export
+# not =
+# ; optional comma separated list of the only sources to export
+# only =
+#
+# The filter is turned into the CRITS mongo query or the SIP query parameters so
+# the server does the work.  When the server can't filter everything (SIP can only
+# require a single source) rows are checked with accepts() instead.
+class SourceFilter(object):
+   def __init__(self, excluded=None, allowed=None):
+      self.excluded = frozenset(excluded or [])
+      self.allowed = frozenset(allowed or [])
+
+   @classmethod
+   def from_config(cls, config):
+      return cls(parse_sources(config.get('sources', 'not', fallback='')),
+                 parse_sources(config.get('sources', 'only', fallback='')))
+
+   # returns a filter that accepts everything any of the given filters accepts
+   @classmethod
+   def union(cls, filters):
+      excluded = frozenset.intersection(*[f.excluded for f in filters])
+      allowed = frozenset()
+      if all([f.allowed for f in filters]):
+         allowed = frozenset.union(*[f.allowed for f in filters])
+      return cls(excluded, allowed)
+
+   # the CRITS indicator query condition, an indicator is exported if any of its sources is allowed
+   def mongo_query(self):
+      condition = { '$nin': [None, ''] + sorted(self.excluded) }
+      if self.allowed:
+         condition['$in'] = sorted(self.allowed)
+      return { 'source': { '$elemMatch': { 'name': condition } } }
+
+   # the SIP indicator query parameters
+   def sip_query(self):
+      query = 'not_sources={}'.format(','.join(sorted(self.excluded)))
+      if len(self.allowed) == 1:
+         query += '&sources={}'.format(next(iter(self.allowed)))
+      return query
+
+   # True if sip_query() does all of the filtering
+   @property
+   def sip_filters_all(self):
+      return len(self.allowed) <= 1
+
+   # checks the sources of a single indicator the same way SIP does
+   # (excluded if any of its sources are excluded)
+   def accepts(self, sources):
+      if not self.excluded.isdisjoint(sources):
+         return False
+      if self.allowed and self.allowed.isdisjoint(sources):
+         return False
+      return True
+
+   def __repr__(self):
+      return 'SourceFilter(excluded={}, allowed={})'.format(sorted(self.excluded), sorted(self.allowed))
+
+def parse_sources(value):
+   return frozenset([x.strip() for x in value.split(',') if x.strip()])
+
+# the names of the sources referencing a SIP indicator, only called when the rows have to be filtered
+# here so an indicator without references is an error instead of passing every allowed list
+def get_sip_sources(row):
+   if 'references' not in row:
+      raise ValueError("SIP indicator {0} has no references, cannot filter it by source".format(row.get('id')))
+
+   return frozenset([ref['source'] for ref in row['references']])
@@ -0,0 +1,155 @@
+# vim: ts=3:sw=3:et
+
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+
+from urllib.parse import quote
+
+import requests
+
+from export_metrics import metrics
+from splunk_lookup import read_lookup_file
+
+# Keeps a splunk KV store collection in sync with the all_indicators lookup
+# table so splunk does not have to reload the whole table every run.  Only the
+# rows that changed since the last successful sync are sent, in batches, to the
+# batch_save endpoint, and the rows that went away are deleted.
+#
+# [splunk_kvstore]
+# ; splunk management url, the KV store is not used when this is empty
+# url = https://splunk.local:8089
+# ; the collection and the app and owner (namespace) it belongs to
+# app = search
+# owner = nobody
+# collection = detect_indicators
+# ; splunk authentication token
+# token =
+# ; verify the certificate of the splunk server
+# verify = yes
+# ; rows sent (or keys deleted) in a single request
+# batch_size = 1000
+# ; file the rows that are in the collection are remembered in, defaults to
+# ; var/<lookup table directory>.kvstore.json so every tenant has its own
+# state_file =
+
+# splunk does not accept more than 1000 documents in a single batch_save
+DEFAULT_BATCH_SIZE = 1000
+
+# keys deleted in a single request go in the url so they are limited separately
+DELETE_BATCH_SIZE = 100
+
+def get_kvstore_url(config):
+   return config.get('splunk_kvstore', 'url', fallback='')
+
+def get_state_file(config, path):
+   default = os.path.join('var', '{0}.kvstore.json'.format(os.path.basename(os.path.dirname(os.path.abspath(path)))))
+   return config.get('splunk_kvstore', 'state_file', fallback='') or default
+
+# the key of a row is the same for as long as the row exists no matter where it ends up in the table
+# the row is identified by every column before ObjectID and ObjectIDs
+def get_row_key(columns):
+   return hashlib.sha1('\0'.join(columns).encode('utf8')).hexdigest()
+
+# returns { key: document } for every row of a lookup table
+def read_lookup_documents(path):
+   documents = {}
+   with io.TextIOWrapper(read_lookup_file(path), encoding='utf8', newline='') as fp:
+      reader = csv.reader(fp)
+      header = next(reader)
+      for row in reader:
+         documents[get_row_key(row[:-2])] = dict(zip(header, row))
+
+   return documents
+
+def load_state(path):
+   if not os.path.exists(path):
+      return {}
+
+   with open(path, 'r') as fp:
+      return json.load(fp)
+
+def save_state(path, documents):
+   directory = os.path.dirname(path)
+   if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+   temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+   with open(temp_path, 'w') as fp:
+      json.dump(documents, fp, sort_keys=True)
+   os.replace(temp_path, path)
+
+def iter_batches(items, batch_size):
+   for index in range(0, len(items), batch_size):
+      yield items[index:index + batch_size]
+
+class KVStoreClient(object):
+   def __init__(self, url, app, owner, collection, token, verify=True):
+      self.url = '{0}/servicesNS/{1}/{2}/storage/collections/data/{3}'.format(url.rstrip('/'), quote(owner, safe=''), quote(app, safe=''), quote(collection, safe=''))
+      self.session = requests.Session()
+      self.session.headers['Content-Type'] = 'application/json'
+      if token:
+         self.session.headers['Authorization'] = 'Bearer {0}'.format(token)
+      self.session.verify = verify
+
+   @classmethod
+   def from_config(cls, config):
+      return cls(config.get('splunk_kvstore', 'url'),
+                 config.get('splunk_kvstore', 'app', fallback='search'),
+                 config.get('splunk_kvstore', 'owner', fallback='nobody'),
+                 config.get('splunk_kvstore', 'collection', fallback='detect_indicators'),
+                 config.get('splunk_kvstore', 'token', fallback=''),
+                 verify=config.getboolean('splunk_kvstore', 'verify', fallback=True))
+
+   # inserts or replaces the documents (each one has a _key)
+   def batch_save(self, documents):
+      payload = json.dumps(documents)
+      response = self.session.post('{0}/batch_save'.format(self.url), data=payload.encode('utf8'))
+      response.raise_for_status()
+      metrics.add('kvstore_bytes_sent', len(payload))
+
+   def delete(self, keys):
+      query = json.dumps({ '$or': [ { '_key': key } for key in keys ] })
+      response = self.session.delete(self.url, params={ 'query': query })
+      response.raise_for_status()
+
+   def close(self):
+      self.session.close()
+
+# sends the rows of the lookup table at path that changed since the last sync to the KV store
+# the state is only saved once everything was sent so a failed sync is retried by the next run
+def sync_kvstore(config, path):
+   if not get_kvstore_url(config):
+      return
+
+   state_path = get_state_file(config, path)
+   batch_size = config.getint('splunk_kvstore', 'batch_size', fallback=DEFAULT_BATCH_SIZE)
+
+   documents = read_lookup_documents(path)
+   previous = load_state(state_path)
+   saved = [ dict(document, _key=key) for key, document in documents.items() if previous.get(key) != document ]
+   deleted = [ key for key in previous if key not in documents ]
+   if not saved and not deleted:
+      logging.info("splunk KV store is up to date with {0}".format(path))
+      return
+
+   client = KVStoreClient.from_config(config)
+   try:
+      for batch in iter_batches(saved, batch_size):
+         client.batch_save(batch)
+      for batch in iter_batches(deleted, min(batch_size, DELETE_BATCH_SIZE)):
+         client.delete(batch)
+   except requests.RequestException as e:
+      logging.error("unable to update the splunk KV store from {0}: {1}".format(path, str(e)))
+      return
+   finally:
+      client.close()
+
+   save_state(state_path, documents)
+   metrics.add('kvstore_saved', len(saved))
+   metrics.add('kvstore_deleted', len(deleted))
+   logging.info("saved {0} rows to and deleted {1} rows from the splunk KV store".format(len(saved), len(deleted)))
@@ -0,0 +1,108 @@
+# vim: ts=3:sw=3:et
+
+import csv
+import gzip
+import io
+
+from contextlib import contextmanager
+
+from export_output import atomic_write, remove_output
+from normalize import splunk_match_keys, splunk_variant_keys
+
+# the columns of every lookup table
+# ObjectID is the first indicator with the value and ObjectIDs lists every indicator with the value
+LOOKUP_HEADER = ('Indicator_Type','Indicator','ObjectID','ObjectIDs')
+
+# the lookup tables are written one of two ways
+#   variants:  a row for every variant of the value splunk might log, matched exactly
+#   canonical: a row for the normalized value and how it is matched (Match_Type) with a
+#              Match_Key for a WILDCARD lookup, see etc/splunk_macros.conf for the splunk side
+LOOKUP_MODES = {
+   'variants': (LOOKUP_HEADER, splunk_variant_keys),
+   'canonical': (('Indicator_Type','Indicator','Match_Type','Match_Key','ObjectID','ObjectIDs'), splunk_match_keys),
+}
+
+def get_lookup_mode(config):
+   mode = config.get('global', 'splunk_lookup_mode', fallback='variants')
+   if mode not in LOOKUP_MODES:
+      raise ValueError("invalid splunk_lookup_mode {0}, expected one of {1}".format(mode, ', '.join(LOOKUP_MODES)))
+   return mode
+
+def get_lookup_header(config):
+   return LOOKUP_MODES[get_lookup_mode(config)][0]
+
+# returns the function that returns the keys of the lookup rows of an (indicator type, value)
+# each key is a tuple of the columns between Indicator_Type and ObjectID
+def get_lookup_keys(config):
+   return LOOKUP_MODES[get_lookup_mode(config)][1]
+
+# splunk reads lookup tables compressed with gzip as long as they are named .csv.gz
+def get_lookup_suffix(config):
+   return '.csv.gz' if config.getboolean('global', 'splunk_lookup_compress', fallback=False) else '.csv'
+
+# opens a lookup table for writing in binary mode (see atomic_write), compressed when it is named .gz
+# the gzip header has no name or time so the file only changes when the rows do
+# the same table in the other format is removed so splunk does not load both
+@contextmanager
+def write_lookup_file(path):
+   if path.endswith('.gz'):
+      with atomic_write(path, 'wb') as fp:
+         with gzip.GzipFile(filename='', mode='wb', fileobj=fp, mtime=0) as gz_fp:
+            yield gz_fp
+      remove_output(path[:-len('.gz')])
+   else:
+      with atomic_write(path, 'wb') as fp:
+         yield fp
+      remove_output(path + '.gz')
+
+# opens a lookup table written by write_lookup_file for reading in binary mode
+def read_lookup_file(path):
+   if path.endswith('.gz'):
+      return gzip.open(path, 'rb')
+   return open(path, 'rb')
+
+# collects the rows of a lookup table so that each key is only written once
+# no matter how many indicators (or variants of the same indicator) have it
+class LookupRows(object):
+   def __init__(self):
+      self.rows = {}
+
+   # key is a tuple from get_lookup_keys, the value comes first
+   def add(self, indicator_type, key, object_id):
+      ids = self.rows.setdefault((indicator_type, key), [])
+      if object_id not in ids:
+         ids.append(object_id)
+
+   # orders the rows by value and the ids of each row so the first id does not depend on download order
+   def sort(self):
+      for ids in self.rows.values():
+         ids.sort()
+      self.rows = dict(sorted(self.rows.items(), key=lambda item: (item[0][0], item[0][1][0].lower(), item[0][1])))
+
+   def __len__(self):
+      return len(self.rows)
+
+   # yields the rows in the order the values were first added (or sorted)
+   def __iter__(self):
+      for (indicator_type, key), ids in self.rows.items():
+         yield (indicator_type,) + key + (ids[0], ' '.join(ids))
+
+# rows are formatted and encoded this many at a time
+FORMAT_BATCH_SIZE = 10000
+
+# writes a lookup table of the header and rows to a file opened in binary mode
+# the rows are formatted in batches and each batch is encoded and written at once
+def write_lookup_table(fp, rows, header=LOOKUP_HEADER):
+   buffer = io.StringIO()
+   writer = csv.writer(buffer)
+   writer.writerow(header)
+   count = 0
+   for row in rows:
+      writer.writerow(row)
+      count += 1
+      if count % FORMAT_BATCH_SIZE == 0:
+         fp.write(buffer.getvalue().encode('utf8'))
+         buffer.seek(0)
+         buffer.truncate()
+
+   fp.write(buffer.getvalue().encode('utf8'))
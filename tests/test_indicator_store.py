@@ -0,0 +1,204 @@
+# vim: ts=3:sw=3:et
+
+# applies SIP deltas to the local indicator store, through SipSource and a stand-in for the SIP api
+# run with: python -m unittest discover tests
+
+import os.path
+import sys
+import tempfile
+import unittest
+
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+from unittest import mock
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import export_engine
+
+from indicator_store import IndicatorStore, TIMESTAMP_FORMAT
+
+TYPES = ['URI - URL', 'Windows - FilePath']
+
+# when the indicators were created, long before any sync
+CREATED = '2020-01-01 00:00:00'
+
+# answers the queries SipSource makes from a list of indicators, one page per query
+class FakeSipClient(object):
+   def __init__(self, indicators):
+      self.indicators = indicators
+
+   def get(self, endpoint):
+      path, _, query = endpoint.partition('?')
+      params = dict([(key, values[0]) for key, values in parse_qs(query, keep_blank_values=True).items()])
+      items = []
+      for item in self.indicators:
+         if 'type' in params and item['type'] != params['type']:
+            continue
+         if 'status' in params and item['status'] != params['status']:
+            continue
+         if 'modified_after' in params and item['modified'] <= params['modified_after']:
+            continue
+         items.append(dict(item))
+
+      return { 'items': items, '_links': {}, '_meta': { 'total_items': len(items) } }
+
+   def close(self):
+      pass
+
+def get_indicator(indicator_id, indicator_type, value, status='Analyzed'):
+   return { 'id': indicator_id, 'type': indicator_type, 'value': value, 'status': status,
+            'references': [{ 'source': 'osint' }], 'modified': CREATED }
+
+# changes an indicator now
+def modify(indicator, **changes):
+   indicator.update(changes)
+   indicator['modified'] = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+
+def get_stored(store, indicator_type):
+   return sorted([(item['id'], item['value']) for item in store.iter_type(indicator_type)])
+
+class ApplyDeltaTest(unittest.TestCase):
+   def setUp(self):
+      self.temp_dir = tempfile.TemporaryDirectory()
+      self.store = IndicatorStore(os.path.join(self.temp_dir.name, 'indicators.db'))
+      self.store.replace_type('URI - URL', [get_indicator(1, 'URI - URL', 'http://a/'), get_indicator(2, 'URI - URL', 'http://b/')])
+      self.store.replace_type('Windows - FilePath', [get_indicator(3, 'Windows - FilePath', 'C:\\a.exe')])
+
+   def tearDown(self):
+      self.store.close()
+      self.temp_dir.cleanup()
+
+   def test_unchanged_indicator_changes_nothing(self):
+      self.assertEqual(self.store.apply_delta([get_indicator(1, 'URI - URL', 'http://a/')], []), set())
+
+   def test_value_change(self):
+      self.assertEqual(self.store.apply_delta([get_indicator(1, 'URI - URL', 'http://c/')], []), set(['URI - URL']))
+      self.assertEqual(get_stored(self.store, 'URI - URL'), [(1, 'http://c/'), (2, 'http://b/')])
+
+   def test_sources_change(self):
+      indicator = get_indicator(1, 'URI - URL', 'http://a/')
+      indicator['references'].append({ 'source': 'vendor' })
+      self.assertEqual(self.store.apply_delta([indicator], []), set(['URI - URL']))
+      self.assertEqual([item['references'] for item in self.store.iter_type('URI - URL') if item['id'] == 1],
+                       [[{ 'source': 'osint' }, { 'source': 'vendor' }]])
+
+   def test_type_change_changes_both_types(self):
+      self.assertEqual(self.store.apply_delta([get_indicator(2, 'Windows - FilePath', 'C:\\b.exe')], []), set(TYPES))
+      self.assertEqual(get_stored(self.store, 'URI - URL'), [(1, 'http://a/')])
+      self.assertEqual(get_stored(self.store, 'Windows - FilePath'), [(2, 'C:\\b.exe'), (3, 'C:\\a.exe')])
+
+   def test_removed(self):
+      self.assertEqual(self.store.apply_delta([], ['3', '99']), set(['Windows - FilePath']))
+      self.assertFalse(self.store.has_type('Windows - FilePath'))
+
+class DeltaSyncTest(unittest.TestCase):
+   def setUp(self):
+      self.temp_dir = tempfile.TemporaryDirectory()
+      self.indicators = [
+         get_indicator(1, 'URI - URL', 'http://a/'),
+         get_indicator(2, 'URI - URL', 'http://b/'),
+         get_indicator(3, 'Windows - FilePath', 'C:\\a.exe'),
+         get_indicator(4, 'Windows - FilePath', 'C:\\b.exe'),
+         get_indicator(5, 'Windows - FilePath', 'C:\\new.exe', status='New'),
+      ]
+      client = FakeSipClient(self.indicators)
+      patcher = mock.patch.object(export_engine, 'get_sip_client', lambda config: client)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+      self.config = ConfigParser()
+      self.store_path = os.path.join(self.temp_dir.name, 'indicators.db')
+
+   def tearDown(self):
+      self.temp_dir.cleanup()
+
+   # runs an export of TYPES, returns type -> the (id, value) of the indicators exported
+   def export(self):
+      exported = {}
+      def export_type(indicator_type, indicators):
+         exported[indicator_type] = sorted([(int(item['id']), item['value']) for item in indicators])
+
+      source = export_engine.SipSource(self.config, indicator_store=self.store_path)
+      try:
+         source.fetch(TYPES, {}, export_type)
+         source.commit()
+      finally:
+         source.close()
+
+      return exported
+
+   def get_stored(self):
+      store = IndicatorStore(self.store_path)
+      try:
+         return dict([(indicator_type, get_stored(store, indicator_type)) for indicator_type in TYPES])
+      finally:
+         store.close()
+
+   def test_first_export_is_a_full_sync(self):
+      self.assertEqual(self.export(), {
+         'URI - URL': [(1, 'http://a/'), (2, 'http://b/')],
+         'Windows - FilePath': [(3, 'C:\\a.exe'), (4, 'C:\\b.exe')],
+      })
+
+   def test_nothing_changed(self):
+      self.export()
+      self.assertEqual(self.export(), {})
+
+   def test_status_no_longer_analyzed(self):
+      self.export()
+      modify(self.indicators[0], status='Deprecated')
+      self.assertEqual(self.export(), { 'URI - URL': [(2, 'http://b/')] })
+      self.assertEqual(self.get_stored()['URI - URL'], [(2, 'http://b/')])
+
+   def test_status_now_analyzed(self):
+      self.export()
+      modify(self.indicators[4], status='Analyzed')
+      self.assertEqual(self.export(), { 'Windows - FilePath': [(3, 'C:\\a.exe'), (4, 'C:\\b.exe'), (5, 'C:\\new.exe')] })
+
+   def test_value_change(self):
+      self.export()
+      modify(self.indicators[2], value='C:\\c.exe')
+      self.assertEqual(self.export(), { 'Windows - FilePath': [(3, 'C:\\c.exe'), (4, 'C:\\b.exe')] })
+
+   def test_type_change(self):
+      self.export()
+      modify(self.indicators[1], type='Windows - FilePath', value='C:\\d.exe')
+      self.assertEqual(self.export(), {
+         'URI - URL': [(1, 'http://a/')],
+         'Windows - FilePath': [(2, 'C:\\d.exe'), (3, 'C:\\a.exe'), (4, 'C:\\b.exe')],
+      })
+
+   def test_type_no_longer_exported(self):
+      self.export()
+      modify(self.indicators[0], type='Hash - MD5', value='0' * 32)
+      self.assertEqual(self.export(), { 'URI - URL': [(2, 'http://b/')] })
+      self.assertEqual(self.get_stored()['URI - URL'], [(2, 'http://b/')])
+
+   def test_delta_sync_reads_only_what_was_modified(self):
+      self.export()
+      modify(self.indicators[3], value='C:\\e.exe')
+      source = export_engine.SipSource(self.config, indicator_store=self.store_path)
+      try:
+         # a change from before the time asked for is not picked up
+         self.assertEqual(source.delta_sync(TYPES, datetime.utcnow() + timedelta(minutes=1)), set())
+         self.assertEqual(source.delta_sync(TYPES, datetime.utcnow() - timedelta(minutes=1)), set(['Windows - FilePath']))
+      finally:
+         source.rollback()
+         source.close()
+
+   def test_failed_export_is_done_again(self):
+      self.export()
+      modify(self.indicators[2], value='C:\\c.exe')
+      source = export_engine.SipSource(self.config, indicator_store=self.store_path)
+      try:
+         source.fetch(TYPES, {}, lambda indicator_type, indicators: list(indicators))
+         source.rollback()
+      finally:
+         source.close()
+
+      self.assertEqual(self.export(), { 'Windows - FilePath': [(3, 'C:\\c.exe'), (4, 'C:\\b.exe')] })
+
+if __name__ == '__main__':
+   unittest.main()
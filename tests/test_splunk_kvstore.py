@@ -0,0 +1,165 @@
+# vim: ts=3:sw=3:et
+
+# syncs lookup tables to a local HTTP stand-in for the splunk KV store REST api
+# run with: python -m unittest discover tests
+
+import json
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import unittest
+
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from splunk_kvstore import get_row_key, sync_kvstore
+from splunk_lookup import write_lookup_file, write_lookup_table
+
+COLLECTION_PATH = '/servicesNS/nobody/search/storage/collections/data/detect_indicators'
+
+# remembers every request it gets, answers them with the status of the server
+class KVStoreHandler(BaseHTTPRequestHandler):
+   def do_POST(self):
+      body = self.rfile.read(int(self.headers['Content-Length']))
+      self.server.requests.append({ 'method': 'POST', 'path': self.path, 'headers': dict(self.headers),
+                                    'documents': json.loads(body.decode('utf8')) })
+      self.send_response(self.server.status)
+      self.end_headers()
+      self.wfile.write(b'[]')
+
+   def do_DELETE(self):
+      url = urlparse(self.path)
+      query = json.loads(parse_qs(url.query)['query'][0])
+      self.server.requests.append({ 'method': 'DELETE', 'path': url.path, 'headers': dict(self.headers),
+                                    'keys': [item['_key'] for item in query['$or']] })
+      self.send_response(self.server.status)
+      self.end_headers()
+
+   def log_message(self, format, *args):
+      pass
+
+class SyncKVStoreTest(unittest.TestCase):
+   def setUp(self):
+      self.server = HTTPServer(('127.0.0.1', 0), KVStoreHandler)
+      self.server.requests = []
+      self.server.status = 200
+      self.thread = threading.Thread(target=self.server.serve_forever)
+      self.thread.start()
+
+      self.temp_dir = tempfile.TemporaryDirectory()
+      self.lookup_path = os.path.join(self.temp_dir.name, 'splunk_lookup_tables', 'all_indicators.csv')
+      os.makedirs(os.path.dirname(self.lookup_path))
+      self.state_path = os.path.join(self.temp_dir.name, 'var', 'kvstore.json')
+
+      self.config = ConfigParser()
+      self.config.read_dict({ 'splunk_kvstore': {
+         'url': 'http://127.0.0.1:{0}/'.format(self.server.server_port),
+         'token': 'secret',
+         'batch_size': '2',
+         'state_file': self.state_path,
+      }})
+
+      # the stand-in is local, whatever proxy the environment has is not
+      environ = mock.patch.dict(os.environ, { 'NO_PROXY': '127.0.0.1', 'no_proxy': '127.0.0.1' })
+      environ.start()
+      self.addCleanup(environ.stop)
+
+   def tearDown(self):
+      self.server.shutdown()
+      self.server.server_close()
+      self.thread.join()
+      self.temp_dir.cleanup()
+
+   def write_lookup(self, rows):
+      with write_lookup_file(self.lookup_path) as fp:
+         write_lookup_table(fp, rows)
+
+   def test_first_sync_saves_every_row_in_batches(self):
+      self.write_lookup([
+         ('Address - ipv4-addr', '10.0.0.1', '1', '1'),
+         ('Address - ipv4-addr', '10.0.0.2', '2', '2 3'),
+         ('URI - Domain Name', 'example.com', '4', '4'),
+      ])
+      sync_kvstore(self.config, self.lookup_path)
+
+      self.assertEqual([request['method'] for request in self.server.requests], ['POST', 'POST'])
+      for request in self.server.requests:
+         self.assertEqual(request['path'], COLLECTION_PATH + '/batch_save')
+         self.assertEqual(request['headers']['Authorization'], 'Bearer secret')
+         self.assertEqual(request['headers']['Content-Type'], 'application/json')
+
+      documents = self.server.requests[0]['documents'] + self.server.requests[1]['documents']
+      self.assertEqual(len(self.server.requests[0]['documents']), 2)
+      self.assertIn({ '_key': get_row_key(['Address - ipv4-addr', '10.0.0.2']), 'Indicator_Type': 'Address - ipv4-addr',
+                      'Indicator': '10.0.0.2', 'ObjectID': '2', 'ObjectIDs': '2 3' }, documents)
+      self.assertEqual(len(documents), 3)
+      self.assertTrue(os.path.exists(self.state_path))
+
+   def test_unchanged_table_sends_nothing(self):
+      self.write_lookup([('Address - ipv4-addr', '10.0.0.1', '1', '1')])
+      sync_kvstore(self.config, self.lookup_path)
+      self.server.requests = []
+
+      sync_kvstore(self.config, self.lookup_path)
+      self.assertEqual(self.server.requests, [])
+
+   def test_only_changed_rows_are_saved_and_removed_rows_deleted(self):
+      self.write_lookup([
+         ('Address - ipv4-addr', '10.0.0.1', '1', '1'),
+         ('Address - ipv4-addr', '10.0.0.2', '2', '2'),
+         ('URI - Domain Name', 'example.com', '4', '4'),
+      ])
+      sync_kvstore(self.config, self.lookup_path)
+      self.server.requests = []
+
+      # a row gets another id, one goes away and one is new
+      self.write_lookup([
+         ('Address - ipv4-addr', '10.0.0.1', '1', '1 5'),
+         ('URI - Domain Name', 'example.com', '4', '4'),
+         ('URI - Domain Name', 'example.org', '6', '6'),
+      ])
+      sync_kvstore(self.config, self.lookup_path)
+
+      saved = [request for request in self.server.requests if request['method'] == 'POST']
+      deleted = [request for request in self.server.requests if request['method'] == 'DELETE']
+      self.assertEqual(len(saved), 1)
+      self.assertEqual(sorted([document['Indicator'] for document in saved[0]['documents']]), ['10.0.0.1', 'example.org'])
+      self.assertEqual(len(deleted), 1)
+      self.assertEqual(deleted[0]['path'], COLLECTION_PATH)
+      self.assertEqual(deleted[0]['keys'], [get_row_key(['Address - ipv4-addr', '10.0.0.2'])])
+
+   def test_failed_sync_is_retried(self):
+      self.write_lookup([('Address - ipv4-addr', '10.0.0.1', '1', '1')])
+      self.server.status = 500
+      with self.assertLogs(level='ERROR'):
+         sync_kvstore(self.config, self.lookup_path)
+      self.assertFalse(os.path.exists(self.state_path))
+
+      self.server.status = 200
+      self.server.requests = []
+      sync_kvstore(self.config, self.lookup_path)
+      self.assertEqual(len(self.server.requests), 1)
+      self.assertEqual(self.server.requests[0]['documents'][0]['Indicator'], '10.0.0.1')
+
+   def test_compressed_table(self):
+      self.lookup_path += '.gz'
+      self.write_lookup([('Address - ipv4-addr', '10.0.0.1', '1', '1')])
+      sync_kvstore(self.config, self.lookup_path)
+      self.assertEqual(len(self.server.requests), 1)
+      self.assertEqual(self.server.requests[0]['documents'][0]['Indicator'], '10.0.0.1')
+
+   def test_disabled_without_url(self):
+      self.config['splunk_kvstore']['url'] = ''
+      self.write_lookup([('Address - ipv4-addr', '10.0.0.1', '1', '1')])
+      sync_kvstore(self.config, self.lookup_path)
+      self.assertEqual(self.server.requests, [])
+      self.assertFalse(os.path.exists(self.state_path))
+
+if __name__ == '__main__':
+   unittest.main()
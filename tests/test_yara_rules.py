@@ -0,0 +1,148 @@
+# vim: ts=3:sw=3:et
+
+# removing duplicate strings, splitting the strings between rules, sorting and validating them
+# run with: python -m unittest discover tests
+
+import io
+import os.path
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yara_rules import dedup_strings, get_shard_count, get_shard_hash, get_shard_name, write_rules, yara
+
+HEADER = 'rule TEMPLATE_RULE_NAME\n{\n    strings:\n'
+FOOTER = '    condition:\n        any of them\n}\n'
+
+def get_strings(values, modifiers='ascii wide nocase'):
+   return [(indicator_id, [('{0}_0'.format(indicator_id), value, modifiers)]) for indicator_id, value in values]
+
+# returns (the rules written, the number of indicators written)
+def render(strings, **kwargs):
+   fp = io.StringIO()
+   count = write_rules(fp, HEADER, FOOTER, 'R', strings, **kwargs)
+   return fp.getvalue(), count
+
+# returns rule name -> the values of its strings
+def parse_rules(rules):
+   parsed = {}
+   for name, body in re.findall(r'rule (\w+)\n\{\n(.*?)    condition:', rules, re.S):
+      parsed[name] = re.findall(r'\$\w+ = "([^"]*)"', body)
+   return parsed
+
+class DedupStringsTest(unittest.TestCase):
+   def test_duplicates_keep_every_id(self):
+      result = dedup_strings(get_strings([(1, 'aaa'), (2, 'AAA'), (3, 'bbb'), (2, 'aaa')]))
+      self.assertEqual(result[0], ('1', [('1_0', 'aaa', 'ascii wide nocase', ['1', '2'])]))
+      self.assertEqual(result[1], ('2', []))
+      self.assertEqual(result[2], ('3', [('3_0', 'bbb', 'ascii wide nocase', ['3'])]))
+      self.assertEqual(result[3], ('2', []))
+
+   def test_case_only_matters_without_nocase(self):
+      result = dedup_strings(get_strings([(1, 'aaa'), (2, 'AAA')], 'ascii wide'))
+      self.assertEqual([len(indicator_strings) for indicator_id, indicator_strings in result], [1, 1])
+
+   def test_different_modifiers_are_not_duplicates(self):
+      result = dedup_strings([(1, [('1_0', 'aaa', 'ascii')]), (2, [('2_0', 'aaa', 'wide')])])
+      self.assertEqual([len(indicator_strings) for indicator_id, indicator_strings in result], [1, 1])
+
+class GetShardCountTest(unittest.TestCase):
+   def test_smallest_power_of_two(self):
+      self.assertEqual(get_shard_count([0, 1, 2, 3], [1, 1, 1, 1], 4), 1)
+      self.assertEqual(get_shard_count([0, 1, 2, 3], [1, 1, 1, 1], 2), 2)
+      self.assertEqual(get_shard_count([0, 1, 2, 3], [1, 1, 1, 1], 1), 4)
+
+   def test_sizes_count(self):
+      self.assertEqual(get_shard_count([0, 1], [3, 1], 3), 2)
+
+   def test_never_more_shards_than_indicators(self):
+      self.assertEqual(get_shard_count([0, 0], [1, 1], 1), 2)
+
+class WriteRulesTest(unittest.TestCase):
+   def assertCompiles(self, rules):
+      if yara is not None:
+         yara.compile(source=rules)
+
+   def test_single_rule(self):
+      rules, count = render(get_strings([(1, 'aaa'), (2, 'bbb')]))
+      self.assertEqual(parse_rules(rules), { 'R': ['aaa', 'bbb'] })
+      self.assertEqual(count, 2)
+      self.assertCompiles(rules)
+
+   def test_duplicates_are_not_written_or_counted(self):
+      rules, count = render(get_strings([(1, 'aaa'), (2, 'aaa'), (3, 'bbb')]))
+      self.assertEqual(parse_rules(rules), { 'R': ['aaa', 'bbb'] })
+      self.assertIn('// 1, 2', rules)
+      self.assertEqual(count, 2)
+
+   def test_nothing_is_written_without_strings(self):
+      self.assertEqual(render([]), ('', 0))
+      self.assertEqual(render([(1, [])]), ('', 0))
+      self.assertEqual(render([(1, [])], max_strings=1), ('', 0))
+
+   def test_shards_hold_at_most_max_strings(self):
+      values = [(indicator_id, 'value{0}'.format(indicator_id)) for indicator_id in range(1, 21)]
+      rules, count = render(get_strings(values), max_strings=4)
+      parsed = parse_rules(rules)
+      self.assertEqual(count, 20)
+      self.assertGreater(len(parsed), 1)
+      self.assertTrue(all([0 < len(shard_values) <= 4 for shard_values in parsed.values()]))
+      self.assertEqual(sorted([value for shard_values in parsed.values() for value in shard_values]), sorted([value for indicator_id, value in values]))
+      self.assertCompiles(rules)
+
+   def test_indicators_are_assigned_by_the_hash_of_their_id(self):
+      values = [(indicator_id, 'value{0}'.format(indicator_id)) for indicator_id in range(1, 21)]
+      rules, count = render(get_strings(values), max_strings=4)
+      shard_count = get_shard_count([get_shard_hash(str(indicator_id)) for indicator_id, value in values], [1] * len(values), 4)
+      for name, shard_values in parse_rules(rules).items():
+         for value in shard_values:
+            self.assertEqual(name, get_shard_name('R', get_shard_hash(value[len('value'):]) & (shard_count - 1)))
+
+   def test_shard_of_duplicates_is_not_written(self):
+      # the second aaa has no strings left and would have a shard of its own
+      rules, count = render(get_strings([(1, 'aaa'), (2, 'aaa'), (3, 'bbb'), (4, 'ccc'), (5, 'ddd')]), max_strings=1)
+      parsed = parse_rules(rules)
+      self.assertEqual(count, 4)
+      self.assertTrue(all(parsed.values()))
+      self.assertEqual(sorted([value for shard_values in parsed.values() for value in shard_values]), ['aaa', 'bbb', 'ccc', 'ddd'])
+      self.assertCompiles(rules)
+
+   def test_sorted_by_value_then_id(self):
+      rules, count = render(get_strings([(3, 'b'), (1, 'C'), (2, 'a'), (4, 'B')], 'ascii'), sort=True)
+      self.assertEqual(parse_rules(rules), { 'R': ['a', 'B', 'b', 'C'] })
+
+      # the same value (without nocase) is ordered by id
+      rules, count = render(get_strings([(2, 'a'), (1, 'a')], 'ascii'), sort=True)
+      self.assertIn('$1_0 = "a"', rules)
+      self.assertNotIn('$2_0', rules)
+
+   def test_unsorted_keeps_the_order(self):
+      rules, count = render(get_strings([(3, 'b'), (1, 'c'), (2, 'a')]))
+      self.assertEqual(parse_rules(rules), { 'R': ['b', 'c', 'a'] })
+
+@unittest.skipIf(yara is None, "yara-python is not installed")
+class ValidateRulesTest(unittest.TestCase):
+   def test_bad_strings_are_quarantined(self):
+      with self.assertLogs(level='ERROR'):
+         rules, count = render(get_strings([(1, 'aaa'), (2, ''), (3, 'bbb')]), validate=True)
+      self.assertEqual(parse_rules(rules), { 'R': ['aaa', 'bbb'] })
+      self.assertEqual(count, 2)
+      yara.compile(source=rules)
+
+   def test_duplicates_of_bad_strings_are_quarantined(self):
+      with self.assertLogs(level='ERROR') as logs:
+         rules, count = render(get_strings([(1, ''), (2, 'aaa'), (3, '')]), validate=True)
+      self.assertEqual(parse_rules(rules), { 'R': ['aaa'] })
+      self.assertEqual(count, 1)
+      self.assertTrue(any(['indicator 3 ' in message for message in logs.output]))
+      yara.compile(source=rules)
+
+   def test_only_bad_strings_write_nothing(self):
+      with self.assertLogs(level='ERROR'):
+         self.assertEqual(render(get_strings([(1, ''), (2, '')]), validate=True), ('', 0))
+         self.assertEqual(render(get_strings([(1, ''), (2, '')]), validate=True, max_strings=1), ('', 0))
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,342 @@
+# vim: ts=3:sw=3:et
+
+import glob
+import io
+import logging
+import multiprocessing
+import os.path
+import time
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from export_logging import get_logging_config_path, init_worker_logging
+from export_output import atomic_write
+from normalize import iter_yara_variants
+
+# yara-python is only needed to validate and compile the rules
+try:
+   import yara
+except ImportError:
+   yara = None
+
+# the header and footer of a rule template contain this where the name of the rule goes
+TEMPLATE_RULE_NAME = 'TEMPLATE_RULE_NAME'
+
+# the strings go here, splitting the template into the header and footer
+TEMPLATE_STRINGS = 'TEMPLATE_STRINGS'
+
+# template used for indicator types that do not have their own
+DEFAULT_TEMPLATE = 'default'
+
+# used to check that a template compiles on its own
+TEMPLATE_CHECK_STRING = ('template_check', 'template check', 'ascii', [])
+
+# maximum number of strings in a single rule, 0 to never split rules
+def get_max_strings(config):
+   return config.getint('global', 'max_strings_per_rule', fallback=0)
+
+# compile every rule before it is written and leave out the indicators that keep it from compiling
+def get_validate_rules(config):
+   if not config.getboolean('global', 'validate_rules', fallback=False):
+      return False
+
+   if yara is None:
+      logging.warning("yara-python is not installed, the rules are not validated")
+      return False
+
+   return True
+
+# file to save all of the compiled rules to, empty to not save them
+def get_compiled_rules(config):
+   return config.get('global', 'compiled_rules', fallback='')
+
+# every template in template_dir read once and split into (header, footer)
+# keyed by the sanitized indicator type the template is for (the file name without .template)
+class TemplateCache(object):
+   # template dir -> (the templates and when they were modified, TemplateCache)
+   loaded = {}
+
+   def __init__(self, template_dir):
+      self.templates = {}
+      for template_path in sorted(glob.glob(os.path.join(template_dir, '*.template'))):
+         with open(template_path, 'r') as fp:
+            rule = fp.read()
+
+         if TEMPLATE_STRINGS not in rule:
+            raise ValueError("template {0} is missing {1}".format(template_path, TEMPLATE_STRINGS))
+
+         name = os.path.splitext(os.path.basename(template_path))[0]
+         self.templates[name] = tuple(rule.split(TEMPLATE_STRINGS, 1))
+
+      logging.debug("loaded {0} templates from {1}".format(len(self.templates), template_dir))
+
+   # returns the templates of the directory, they are only read again when they change
+   # so an exporter that keeps running does not read them for every export
+   @classmethod
+   def load(cls, template_dir):
+      signature = [(template_path, os.path.getmtime(template_path)) for template_path in sorted(glob.glob(os.path.join(template_dir, '*.template')))]
+      if template_dir not in cls.loaded or cls.loaded[template_dir][0] != signature:
+         cls.loaded[template_dir] = (signature, cls(template_dir))
+      return cls.loaded[template_dir][1]
+
+   # returns (header, footer) of the template for the given sanitized type or of the default template
+   def get(self, name):
+      if name in self.templates:
+         return self.templates[name]
+
+      logging.debug("using the {0} template for {1}".format(DEFAULT_TEMPLATE, name))
+      return self.templates[DEFAULT_TEMPLATE]
+
+# returns the executor the rules are rendered in (with render_rules_text())
+# [global] render_workers is the number of worker processes, 0 to render in this process (returns None)
+# the first rules are submitted from the fetch threads, forking then could copy a lock another thread
+# holds (logging, metrics, the indicator store, connection pools) so the workers start from a forkserver
+def get_render_executor(config):
+   render_workers = config.getint('global', 'render_workers', fallback=0)
+   if render_workers > 0:
+      logging.debug("rendering rules in {0} worker processes".format(render_workers))
+      return ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context('forkserver'),
+                                 initializer=init_worker_logging, initargs=(get_logging_config_path(),))
+   return None
+
+def format_yara_string(tmpstr):
+   out = tmpstr.replace("\\","\\\\")
+   out = out.replace("\"","\\\"")
+   out = out.replace("\n","")
+   
+   return out
+
+# yields (indicator id, [(string id, value, modifiers), ...]) for each indicator
+# the id of each indicator is item[id_key]
+def iter_rule_strings(indicators, modifiers, id_key='id', strip_url_scheme=False):
+   for item, variants in iter_yara_variants(indicators, strip_url_scheme):
+      yield item[id_key], [('{}{}'.format(item[id_key], suffix), format_yara_string(item_value), modifiers) for suffix, item_value in variants]
+
+# indicators are assigned to shards by a hash of their id so they stay in the same
+# shard from one run to the next as long as the number of shards does not change
+def get_shard_hash(indicator_id):
+   return zlib.crc32(str(indicator_id).encode('utf8'))
+
+# returns the smallest power of two number of shards that keeps every shard at or under max_strings
+# doubling the number of shards splits every shard in two, the strings never move between the others
+def get_shard_count(shard_hashes, shard_sizes, max_strings):
+   shard_count = 1
+   while shard_count < len(shard_hashes):
+      counts = [0] * shard_count
+      for shard_hash, size in zip(shard_hashes, shard_sizes):
+         counts[shard_hash & (shard_count - 1)] += size
+
+      if max(counts) <= max_strings:
+         break
+
+      shard_count *= 2
+
+   return shard_count
+
+def get_shard_name(rule_name, shard):
+   return '{}_{:04d}'.format(rule_name, shard + 1)
+
+def format_string(string_id, value, modifiers, ids):
+   # strings shared by several indicators list all of them
+   comment = ''
+   if len(ids) > 1:
+      comment = ' // {}'.format(', '.join(ids))
+   return '        ${} = "{}" {}{}\n'.format(string_id, value, modifiers, comment)
+
+# orders the indicators by their (case insensitive) string values and then by id
+# strings is an iterable of (indicator id, [(string id, value, modifiers), ...])
+def sort_strings(strings):
+   def key(indicator):
+      indicator_id, indicator_strings = indicator
+      return ([(value.lower(), value) for string_id, value, modifiers in indicator_strings], str(indicator_id))
+   return sorted(strings, key=key)
+
+# removes the strings that would match exactly the same thing as an earlier string
+# keeps the ids of every indicator that had the string with the first one
+# strings is an iterable of (indicator id, [(string id, value, modifiers), ...])
+# returns a list of (indicator id, [(string id, value, modifiers, ids), ...])
+def dedup_strings(strings):
+   seen = {}
+   result = []
+   for indicator_id, indicator_strings in strings:
+      indicator_id = str(indicator_id)
+      unique = []
+      for string_id, value, modifiers in indicator_strings:
+         key = (value.lower() if 'nocase' in modifiers.split() else value, modifiers)
+         ids = seen.get(key)
+         if ids is not None:
+            if indicator_id not in ids:
+               ids.append(indicator_id)
+            continue
+
+         ids = seen[key] = [indicator_id]
+         unique.append((string_id, value, modifiers, ids))
+
+      result.append((indicator_id, unique))
+
+   return result
+
+# returns the error compiling a rule with the given (deduplicated) strings or None if it compiles
+def get_compile_error(header, footer, rule_name, strings):
+   source = [header.replace(TEMPLATE_RULE_NAME, rule_name)]
+   for indicator_id, indicator_strings in strings:
+      source.extend([format_string(*string) for string in indicator_strings])
+   source.append(footer.replace(TEMPLATE_RULE_NAME, rule_name))
+
+   try:
+      yara.compile(source=''.join(source))
+   except yara.Error as e:
+      return str(e)
+
+   return None
+
+# finds the indicators that keep the rule from compiling by compiling each half of the strings
+# that do not compile until the halves that still fail are single indicators
+# returns [(indicator id, error), ...]
+def find_compile_errors(header, footer, rule_name, strings):
+   error = get_compile_error(header, footer, rule_name, strings)
+   if error is None:
+      return []
+
+   if len(strings) == 1:
+      return [(strings[0][0], error)]
+
+   middle = len(strings) // 2
+   return find_compile_errors(header, footer, rule_name, strings[:middle]) + \
+          find_compile_errors(header, footer, rule_name, strings[middle:])
+
+# removes the indicators whose strings do not compile from the (deduplicated) strings of a rule
+def validate_strings(header, footer, rule_name, strings):
+   # a rule without strings never compiles, indicators without (unique) strings can't be the problem
+   with_strings = [indicator for indicator in strings if indicator[1]]
+   if not with_strings:
+      return strings
+
+   # if the template itself is broken then every indicator would fail
+   error = get_compile_error(header, footer, rule_name, [(None, [TEMPLATE_CHECK_STRING])])
+   if error is not None:
+      logging.error("the template of {0} does not compile: {1}".format(rule_name, error))
+      return strings
+
+   errors = find_compile_errors(header, footer, rule_name, with_strings)
+   if not errors:
+      return strings
+
+   for indicator_id, error in errors:
+      logging.error("quarantined indicator {0} of {1}: {2}".format(indicator_id, rule_name, error))
+
+   # the indicators that had the same strings as a quarantined one (and lost them as duplicates) are left out as well
+   quarantined = set([indicator_id for indicator_id, error in errors])
+   duplicates = set()
+   for indicator_id, indicator_strings in with_strings:
+      if indicator_id in quarantined:
+         for string_id, value, modifiers, ids in indicator_strings:
+            duplicates.update(ids)
+   duplicates -= quarantined
+   for indicator_id in sorted(duplicates):
+      logging.error("quarantined indicator {0} of {1}: it has the same strings as a quarantined indicator".format(indicator_id, rule_name))
+   quarantined.update(duplicates)
+
+   logging.warning("left {0} indicators that do not compile out of {1}".format(len(quarantined), rule_name))
+   return [indicator for indicator in strings if indicator[0] not in quarantined]
+
+# compiles every rule file in rule_dir into a single file the scanners can load without compiling them again
+# each rule file is compiled into a namespace named after the file
+def save_compiled_rules(rule_dir, output_path):
+   if yara is None:
+      logging.warning("yara-python is not installed, cannot save the compiled rules to {0}".format(output_path))
+      return
+
+   rule_paths = sorted(glob.glob(os.path.join(rule_dir, '*.yar')))
+   try:
+      rules = yara.compile(filepaths=dict([(os.path.splitext(os.path.basename(path))[0], path) for path in rule_paths]))
+   except yara.Error as e:
+      logging.error("unable to compile the rules in {0}: {1}".format(rule_dir, str(e)))
+      return
+
+   with atomic_write(output_path, 'wb') as fp:
+      rules.save(file=fp)
+
+   logging.info("saved {0} compiled rule files to {1}".format(len(rule_paths), output_path))
+
+# writes a rule with the given name from the header and footer of a template
+# strings is an iterable of (indicator id, [(string id, escaped value, modifiers), ...]) for each indicator
+# if max_strings is set and there are more strings than that, the strings are split between
+# several rules named rule_name_0001, rule_name_0002, etc... all written to fp
+# if sort is set the indicators are written in the order of sort_strings()
+# if validate is set the indicators whose strings do not compile are left out
+# indicators without strings left (every one was a duplicate) are not written, nothing is written without any strings
+# returns the number of indicators written
+def write_rules(fp, header, footer, rule_name, strings, max_strings=0, sort=False, validate=False):
+   if sort:
+      strings = sort_strings(strings)
+   strings = dedup_strings(strings)
+   if validate:
+      strings = validate_strings(header, footer, rule_name, strings)
+
+   # a rule without strings does not compile
+   strings = [indicator for indicator in strings if indicator[1]]
+   if not strings:
+      return 0
+
+   if not max_strings:
+      fp.write(header.replace(TEMPLATE_RULE_NAME, rule_name))
+      for indicator_id, indicator_strings in strings:
+         fp.writelines([format_string(*string) for string in indicator_strings])
+
+      fp.write(footer.replace(TEMPLATE_RULE_NAME, rule_name))
+      return len(strings)
+
+   shard_hashes = [get_shard_hash(indicator_id) for indicator_id, indicator_strings in strings]
+   shard_sizes = [len(indicator_strings) for indicator_id, indicator_strings in strings]
+   if sum(shard_sizes) <= max_strings:
+      shard_count = 1
+   else:
+      shard_count = get_shard_count(shard_hashes, shard_sizes, max_strings)
+      logging.debug("splitting {0} strings of {1} between {2} rules".format(sum(shard_sizes), rule_name, shard_count))
+
+   shards = [[] for shard in range(shard_count)]
+   for shard_hash, indicator in zip(shard_hashes, strings):
+      shards[shard_hash & (shard_count - 1)].append(indicator)
+
+   for shard, shard_strings in enumerate(shards):
+      # skip empty shards, every indicator left has strings
+      if not shard_strings:
+         continue
+
+      shard_name = rule_name if shard_count == 1 else get_shard_name(rule_name, shard)
+      if shard:
+         fp.write('\n')
+      fp.write(header.replace(TEMPLATE_RULE_NAME, shard_name))
+      for indicator_id, indicator_strings in shard_strings:
+         fp.writelines([format_string(*string) for string in indicator_strings])
+      fp.write(footer.replace(TEMPLATE_RULE_NAME, shard_name))
+
+   return len(strings)
+
+# renders the rules of a single indicator type to fp
+# indicators is a list of indicators of the type and modifiers are the modifiers of their strings
+# returns stats, a dict of the number of indicators written, the number of strings they
+# expanded to (before duplicates are removed) and how long it took
+def render_rules(fp, header, footer, rule_name, indicators, modifiers, id_key='id', strip_url_scheme=False,
+                 max_strings=0, sort=False, validate=False):
+   start = time.perf_counter()
+   stats = { 'strings': 0 }
+   def iter_counted(strings):
+      for indicator_id, indicator_strings in strings:
+         stats['strings'] += len(indicator_strings)
+         yield indicator_id, indicator_strings
+
+   stats['indicators'] = write_rules(fp, header, footer, rule_name, iter_counted(iter_rule_strings(indicators, modifiers, id_key, strip_url_scheme)),
+                                     max_strings, sort, validate)
+   stats['render_seconds'] = time.perf_counter() - start
+   return stats
+
+# renders the rules of a single indicator type in a render worker process, which can't write to the
+# file the exporter has open, so the text of the rules is sent back to be written
+# returns (the text of the rules, stats)
+def render_rules_text(*args, **kwargs):
+   fp = io.StringIO()
+   stats = render_rules(fp, *args, **kwargs)
+   return fp.getvalue(), stats